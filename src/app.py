@@ -1,7 +1,8 @@
 import os
+import atexit
 from config import set_env_vars, check_chirpstack_server_and_api, check_influxdb_server_auth_and_resources, check_rabbitmq_server, check_config, set_config_file, check_telegram_status, get_chripstack_details,get_telegram_details
 set_env_vars()
-from flask import Flask, request, Response, render_template, jsonify, redirect, url_for, make_response, flash
+from flask import Flask, request, Response, render_template, jsonify, redirect, url_for, make_response, flash, stream_with_context
 from flask_cors import CORS
 from db import gateway_database, device_database, alert_database, gw_alert_database, user_database
 with alert_database() as db:
@@ -9,11 +10,17 @@ with alert_database() as db:
 with gw_alert_database() as db:
     db.clear_alert_table()
 from application_api import get_tenant_count, get_app_count
-from gateway_api import get_gateway_details, get_gateway_metrics, get_gateways_status
-from device_api import get_dev_details, get_dev_status, get_device_metrics
-from alert_api import get_alert_status, get_dev_alerts, get_gw_alert_status, get_gw_alerts
-from celery_tasks import celery_init_app, update_influx, configure_celery_beat
-from location import rev_geocode
+from gateway_api import get_gateway_details, get_gateways_details
+from device_api import get_dev_details
+from metrics_cache import chart_metrics
+from inventory import get_snapshot, get_status
+from events import broker
+from versions import counters
+from alert_api import get_alert_status, get_dev_alerts, get_gw_alert_status, get_gw_alerts, get_alert_page, get_gw_alert_page
+from paging import wants_page, page_args, page_envelope
+from celery_tasks import celery_init_app, update_influx, update_influx_batch, configure_celery_beat, report_gateway_location, location_updates
+from ingest import uplink_batcher
+from telegram_bot import notifier
 from flask_jwt_extended import (JWTManager, jwt_required, get_jwt_identity,
                                 create_access_token,
                                 set_access_cookies,
@@ -52,6 +59,48 @@ celery_app = celery_init_app(app)
 
 configure_celery_beat(celery_app)
 
+# 'batch' groups uplinks for a few milliseconds into one update_influx_batch task, 'single' sends one task per uplink
+ingest_mode = os.getenv('INGEST_MODE', 'batch')
+uplink_batch = uplink_batcher(
+    lambda uplinks: update_influx_batch.apply_async(args=[uplinks]),
+    max_size=int(os.getenv('INGEST_BATCH_SIZE', 200)),
+    max_delay=float(os.getenv('INGEST_BATCH_DELAY', 0.05))
+)
+atexit.register(uplink_batch.flush)
+atexit.register(location_updates.flush)
+atexit.register(notifier.flush)
+
+def not_modified(etag):
+    # Answered before the user lookup: a 304 carries no data and the JWT is already verified
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return None
+
+def tagged_json(data, etag):
+    # no-cache makes browsers revalidate with If-None-Match instead of reusing the body blindly
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def with_event_id(response, event_id):
+    # Read before the list query, a stream opened from this id replays every alert change the list may have missed
+    if isinstance(response, Response):
+        response.headers['X-Event-Id'] = event_id
+    return response
+
+def paged_json(query, sortable, filters, etag):
+    # One keyset page wrapped as {"items": [...], "next_cursor": ...}, requested with ?limit=&cursor=&sort=&order= and filters
+    try:
+        kwargs = page_args(request.args, sortable, filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    rows, last = query(**kwargs)
+    return tagged_json(page_envelope(rows, last), etag)
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('login.html')
@@ -67,7 +116,10 @@ def dashboard():
             name, username = db.fetch_user(uid)
     if check_config():
         csrf_token = (get_jwt() or {}).get("csrf")
-        return render_template("dashboard.html", tenant_count=get_tenant_count(), app_count=get_app_count(), name=name, username=username, csrf_token=csrf_token)
+        snapshot = get_snapshot() or {}
+        tenant_count = snapshot.get('tenant_count', get_tenant_count())
+        app_count = snapshot.get('app_count', get_app_count())
+        return render_template("dashboard.html", tenant_count=tenant_count, app_count=app_count, name=name, username=username, csrf_token=csrf_token)
     else:
         flash("Configuration Check Failed -- One or more of the required dependencies have not been met")
         return redirect(url_for('config_details'))
@@ -75,20 +127,35 @@ def dashboard():
 @app.route('/device_alerts', methods=['GET'])
 @jwt_required()
 def device_status():
+    # Rows carry the device's gateway name, so device and gateway writes change them too
+    event_id = broker.current_event_id()
+    etag = counters.etag('alert', 'device', 'gateway')
+    cached = not_modified(etag)
+    if cached:
+        return with_event_id(cached, event_id)
     uid = get_jwt_identity()
     with user_database() as db:
         if not db.check_uid_registered(uid):
             return redirect(url_for('index'))
-    return jsonify(get_alert_status())
+    if wants_page(request.args):
+        return with_event_id(paged_json(get_alert_page, alert_database.sortable, ('severity', 'issue', 'gateway', 'name'), etag), event_id)
+    return with_event_id(tagged_json(get_alert_status(), etag), event_id)
 
 @app.route('/gateway_alerts', methods=['GET'])
 @jwt_required()
 def gateway_alerts():
+    event_id = broker.current_event_id()
+    etag = counters.etag('gw_alert')
+    cached = not_modified(etag)
+    if cached:
+        return with_event_id(cached, event_id)
     uid = get_jwt_identity()
     with user_database() as db:
         if not db.check_uid_registered(uid):
             return redirect(url_for('index'))
-    return jsonify(get_gw_alert_status())
+    if wants_page(request.args):
+        return with_event_id(paged_json(get_gw_alert_page, gw_alert_database.sortable, ('severity', 'issue', 'gateway', 'name'), etag), event_id)
+    return with_event_id(tagged_json(get_gw_alert_status(), etag), event_id)
     
 @app.route('/status_data', methods=['GET'])
 @jwt_required()
@@ -97,10 +164,26 @@ def status_data():
     with user_database() as db:
         if not db.check_uid_registered(uid):
             return redirect(url_for('index'))
-    return {
-        'gateways': get_gateways_status(),
-        'devices': get_dev_status()
-    }
+    return get_status()
+
+@app.route('/events', methods=['GET'])
+@jwt_required()
+def events():
+    uid = get_jwt_identity()
+    with user_database() as db:
+        if not db.check_uid_registered(uid):
+            return redirect(url_for('index'))
+    # Browsers resend the id of the last event on reconnect, the query parameter covers a fresh EventSource
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscriber = broker.subscribe(last_event_id)
+    if subscriber is None:
+        # Every stream holds a server thread, past the cap clients poll instead of starving other requests
+        return jsonify({"error": "Too many event streams"}), 503, {'Retry-After': '300'}
+    response = Response(stream_with_context(broker.stream(subscriber)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Releases the slot even if the body is never iterated
+    response.call_on_close(lambda: broker.unsubscribe(subscriber))
+    return response
 
 
 @app.route('/login', methods=['POST'])
@@ -440,7 +523,7 @@ def gateway_metrics():
     gateway_uid = request.args.get('uid')
     with gateway_database() as db:
         gateway_id = db.fetch_gateway_eui(gateway_uid)
-    return get_gateway_metrics(gateway_id)
+    return chart_metrics.get('gateway', gateway_id)
 
 @app.route('/device_metrics', methods=['GET'])
 @jwt_required()
@@ -453,29 +536,51 @@ def device_metrics():
     device_uid = request.args.get('uid')
     with device_database() as db:
         device_id = db.fetch_device_eui(device_uid)
-    return get_device_metrics(device_id)
+    return chart_metrics.get('device', device_id)
 
 @app.route('/gateway_data', methods=["GET"])
 @jwt_required()
 def gateway_data():
+    etag = counters.etag('gateway')
+    cached = not_modified(etag)
+    if cached:
+        return cached
     uid = get_jwt_identity()
     with user_database() as db:
         if not db.check_uid_registered(uid):
             return redirect(url_for('index'))
     with gateway_database() as db:
+        if wants_page(request.args):
+            return paged_json(db.gateway_page, db.sortable, ('name',), etag)
         rows=db.gateway_query()
-    return jsonify(rows)
+    return tagged_json(rows, etag)
+
+@app.route('/gateway_details', methods=["GET"])
+@jwt_required()
+def gateway_details():
+    uid = get_jwt_identity()
+    with user_database() as db:
+        if not db.check_uid_registered(uid):
+            return redirect(url_for('index'))
+    # Details of several gateways in one call, e.g. /gateway_details?id=<eui>&id=<eui>
+    return jsonify(get_gateways_details(request.args.getlist('id')))
 
 @app.route('/device_data', methods=["GET"])
 @jwt_required()
 def device_data():
+    etag = counters.etag('device')
+    cached = not_modified(etag)
+    if cached:
+        return cached
     uid = get_jwt_identity()
     with user_database() as db:
         if not db.check_uid_registered(uid):
             return redirect(url_for('index'))
     with device_database() as db:
+        if wants_page(request.args):
+            return paged_json(db.device_page, db.sortable, ('gateway', 'name'), etag)
         rows=db.device_query()
-    return jsonify(rows)       
+    return tagged_json(rows, etag)       
 
 
 @app.route('/data', methods=['POST'])
@@ -504,7 +609,10 @@ def data():
         
         # Update device metrics
         try:   
-            update_influx.apply_async(args=[metrics_data, coordinates, device_addr])
+            if ingest_mode == 'batch':
+                uplink_batch.add(metrics_data, coordinates, device_addr)
+            else:
+                update_influx.apply_async(args=[metrics_data, coordinates, device_addr])
             
         except Exception as e:
             logger.error(f"Error updating metrics: {e}")
@@ -615,31 +723,10 @@ def data():
         location = data.get('location', {})
         if location != {}:
             with device_database() as db:
-                gateway_id = db.check_device_gw(device_id)
-            with gateway_database() as db:
-                gateway_location = db.fetch_gateway_location(gateway_id)
-                gateway_name = db.fetch_gateway_name(gateway_id)
-                try:
-                    lat, long, alt = str(db.fetch_gateway_coordinates).split(',')
-                except:
-                    lat = long = alt = ''
-            if lat == '' and long == '' and alt == '':
-                    with gateway_database() as db:
-                        db.set_gateway_coord(gateway_id, f'{lat},{long},{alt}')
-            elif location['latitude'] != lat or location['longitude'] != long or location['altitude'] != alt:
-                with gateway_database() as db:
-                    db.set_gateway_coord(gateway_id, f'{lat},{long},{alt}')
-                with gw_alert_database() as db:
-                    logger.info(db.alert_write(gateway_name, gateway_id, 'Gateway Location Changed', f'Location of {gateway_name} has changed by ({lat-location['latitude']}, {long-location['longitude']}, {alt-location['altitude']})', 'critical'))
-            if gateway_location is None:
-                try:
-                    gateway_location = rev_geocode(location['latitude'], location['longitude'], metrics_data.get(gateway_id))
-                    with gateway_database() as db:
-                        db.set_gateway_address(gateway_id, gateway_location)
-                except KeyError as e:
-                    logger.error(f"KeyError encountered: {e}")
-
-
+                gateway_id = db.get_dev_gw(device_id)
+            # Shift detection and geocoding run in update_gateway_locations, the webhook only queues the position
+            if gateway_id not in (None, "Unknown"):
+                report_gateway_location(gateway_id, location)
 
     return '', 204  # No Content
 
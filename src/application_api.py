@@ -1,38 +1,40 @@
-import os
-import grpc
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from chirpstack_api import api
-from google.protobuf.json_format import MessageToJson
 from datetime import datetime, timedelta
 from google.protobuf.timestamp_pb2 import Timestamp
 from tenant_api import get_tenant_list
+from chirpstack import get_stub, paginate, MAX_CONCURRENCY
+from protobuf_convert import application_item_to_dict
 
 application_count = 0
 tenant_count = 0
 
 def get_application_list():
+    return list(iter_all_applications())
 
+def iter_all_applications(max_workers=None):
+    """
+    Yields the applications of every tenant. Tenants are listed concurrently and
+    each tenant's applications are yielded as soon as its listing completes.
+    """
     global tenant_count, application_count
     application_count = 0
     tenant_count = 0
-    # Get environment variables
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-    chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-    auth_token = [("authorization", "Bearer %s" % api_token)]
-    application_list=[]
-    with grpc.insecure_channel(chirpstack_server) as channel:
-        tenant_list=get_tenant_list()
-        tenant_count += len(tenant_list)
-        for i in range(len(tenant_list)):
-                client = api.ApplicationServiceStub(channel)
-                req = api.ListApplicationsRequest()
-                req.limit = 100 #mandatory if you want details
-                req.tenant_id = tenant_list[i]['id']
-                resp = client.List(req, metadata=auth_token)
-                resp_json = json.loads(MessageToJson(resp))
-                application_count += resp_json['totalCount']
-                application_list += resp_json['result']
-    return application_list
+    tenant_list=get_tenant_list() or []
+    tenant_count += len(tenant_list)
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_CONCURRENCY) as executor:
+        futures = [executor.submit(list_applications, tenant['id']) for tenant in tenant_list]
+        for future in as_completed(futures):
+            applications = future.result()
+            application_count += len(applications)
+            yield from applications
+
+def list_applications(tenant_id):
+    return [application_item_to_dict(application) for application in iter_applications(tenant_id)]
+
+def iter_applications(tenant_id):
+    client = get_stub(api.ApplicationServiceStub)
+    return paginate(client.List, api.ListApplicationsRequest, tenant_id=tenant_id)
 
 def get_tenant_count():
      return tenant_count
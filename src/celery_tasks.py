@@ -1,10 +1,17 @@
+import os
+import time
 from flask import Flask
 from celery import Celery, shared_task, Task
+from celery.signals import worker_process_shutdown, worker_shutdown
 import influxdb_client
-from influxdb_client.client.write_api import SYNCHRONOUS
+import numpy as np
 from db import gateway_database, device_database, alert_database, gw_alert_database
-from location import rev_geocode
-from influx import get_influxdb_client
+from location import rev_geocode, distance_km, parse_coordinates, location_batcher
+from registry import registry
+from inventory import refresh_snapshot
+from detection import detection_engine, format_message
+from influx import get_influxdb_client, get_batch_writer, close_batch_writer, query_packet_rates, query_signal_quality
+from telegram_bot import notifier
 from log import logger
 
 
@@ -24,12 +31,8 @@ def celery_init_app(app: Flask) -> Celery:
 
 def configure_celery_beat(celery_app: Celery):
     celery_app.conf.beat_schedule = {
-        'dev_packet-rate-task': {
-            'task': 'celery_tasks.dev_packet_rate_task',  # Reference your task name
-            'schedule': 60.0,  # Run every 60 seconds
-        },
-        'gw_packet-rate-task': {
-            'task': 'celery_tasks.gw_packet_rate_task',  # Reference your task name
+        'packet-rate-task': {
+            'task': 'celery_tasks.packet_rate_task',  # Gateways then devices, so correlation sees this cycle's Offline alerts
             'schedule': 60.0,  # Run every 60 seconds
         },
         'dev_signal-strength-task': {
@@ -39,15 +42,48 @@ def configure_celery_beat(celery_app: Celery):
         'gw_signal-strength-task': {
             'task': 'celery_tasks.gw_signal_strength_task',  # Reference your task name
             'schedule': 300.0,  # Run every 300 seconds
+        },
+        'inventory-refresh-task': {
+            'task': 'celery_tasks.inventory_refresh_task',  # Reference your task name
+            'schedule': float(os.getenv('INVENTORY_REFRESH_INTERVAL', 60)),  # Run every 60 seconds by default
         }
     }
 
 client, bucket, org = get_influxdb_client()
-write_api = client.write_api(write_options=SYNCHRONOUS)
 query_api = client.query_api()
+engine = detection_engine()
 
-@shared_task
-def update_influx(metrics_data, coordinates, device_addr):
+# Horizontal distance (metres) a gateway must move before its new position is recorded and alerted
+LOCATION_SHIFT_TOLERANCE = float(os.getenv('LOCATION_SHIFT_TOLERANCE', 100))
+
+# Flush buffered uplink points, gateway positions and pending notifications before a worker process exits
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_influx_writer(**kwargs):
+    close_batch_writer()
+    location_updates.flush()
+    notifier.flush()
+
+def report_gateway_location(gateway_id, coordinates):
+    """
+    Queue a reported gateway position for update_gateway_locations unless the
+    registry already holds an address and coordinates within the shift
+    tolerance of it. Geocoding and shift alerts never run on the ingest path.
+    """
+    try:
+        lat, long = float(coordinates['latitude']), float(coordinates['longitude'])
+        alt = float(coordinates.get('altitude', 0))
+    except (KeyError, TypeError, ValueError):
+        return
+    gateway = registry.get_gateway(gateway_id)
+    if gateway is None:
+        return
+    stored = parse_coordinates(gateway['coordinates'])
+    if gateway['address'] and stored and distance_km(stored[0], stored[1], lat, long) * 1000 <= LOCATION_SHIFT_TOLERANCE:
+        return
+    location_updates.report(gateway_id, lat, long, alt)
+
+def process_uplink(metrics_data, coordinates, device_addr, gw_db, dev_db):
     device_name = metrics_data.get('device_name', 'Unknown')
     device_id = metrics_data.get('device_id', 'Unknown')
     gateway_id = metrics_data.get('gateway_id', 'Unknown')
@@ -58,236 +94,215 @@ def update_influx(metrics_data, coordinates, device_addr):
         logger.info("Frame-Count Reset")
         with alert_database() as db:
             db.alert_write(device_name, device_id, "Device Reset", "Frame Count is reset to 0", 'critical')
-    with gateway_database() as db:
-            gateway_location = db.fetch_gateway_location(gateway_id)
-            gateway_name = db.fetch_gateway_name(gateway_id)
-            try:
-                lat, long, alt = str(db.fetch_gateway_coordinates(gateway_id)).split(',')
-            except:
-                lat = long = alt = ''
-            with device_database() as db1:
-                check = db1.check_device_registered(device_id)
-                if check == 0:
-                    pass
-                elif not db1.check_device_addr(device_id):
-                    db1.set_dev_addr(device_id, device_addr)
-                    logger.info("Device Address Recorded: "+device_name+" --> "+device_addr)
-                elif not db1.check_device_gw(device_id):
-                    db1.set_dev_gw(device_id, gateway_id)
-                    logger.info("Device Gateway Recorded: "+device_name+" --> "+gateway_name)
-            if coordinates != {}:
-                if lat == '' and long == '' and alt == '':
-                     with gateway_database() as db:
-                        db.set_gateway_coord(gateway_id, f'{lat},{long},{alt}')
-                elif coordinates['latitude'] != lat or coordinates['longitude'] != long or coordinates['altitude'] != alt:
-                    with gateway_database() as db:
-                        db.set_gateway_coord(gateway_id, f'{lat},{long},{alt}')
-                    with gw_alert_database() as db:
-                        logger.info(db.alert_write(gateway_name, gateway_id, 'Gateway Location Changed', f'Location of {gateway_name} has changed by ({lat-coordinates['latitude']}, {long-coordinates['longitude']}, {alt-coordinates['altitude']})', 'critical'))
-                if gateway_location is None:
-                    try:
-                        gateway_location = rev_geocode(coordinates['latitude'], coordinates['longitude'], metrics_data.get(gateway_id))
-                        with gateway_database() as db:
-                            db.set_gateway_address(gateway_id, gateway_location)
-                    except KeyError as e:
-                        logger.error(f"KeyError encountered: {e}")
-            try:
-                p = influxdb_client.Point("uplink_metrics").tag("device_id", device_id).tag("gateway_id", gateway_id).field("f_cnt", f_cnt).field("rssi", rssi).field("snr", snr)
-                write_api.write(bucket=bucket, org=org, record=p)
+    # Device and gateway metadata come from the in-memory registry, SQLite is only touched on writes
+    gateway = registry.get_gateway(gateway_id) or {}
+    device = registry.get_device(device_id)
+    gateway_name = gateway.get('name', "Unknown")
+    if device is None:
+        pass
+    elif device['dev_addr'] == "Unknown":
+        dev_db.set_dev_addr(device_id, device_addr)
+        logger.info("Device Address Recorded: "+device_name+" --> "+device_addr)
+    elif device['gw_id'] == "Unknown":
+        dev_db.set_dev_gw(device_id, gateway_id)
+        logger.info("Device Gateway Recorded: "+device_name+" --> "+gateway_name)
+    report_gateway_location(gateway_id, coordinates)
+    p = influxdb_client.Point("uplink_metrics").tag("device_id", device_id).tag("gateway_id", gateway_id).field("f_cnt", f_cnt).field("rssi", rssi).field("snr", snr).time(time.time_ns())
+    get_batch_writer().write(p)
+
+@shared_task
+def update_influx(metrics_data, coordinates, device_addr):
+    try:
+        with gateway_database() as gw_db, device_database() as dev_db:
+            process_uplink(metrics_data, coordinates, device_addr, gw_db, dev_db)
+        logger.info(f"Simulating database update for: {metrics_data}")
+        return "Metrics and database updated successfully"
+
+    except Exception as e:
+        return str(e)
 
-                
-                logger.info(f"Simulating database update for: {metrics_data}")
-                return "Metrics and database updated successfully"
-            
+@shared_task
+def update_influx_batch(uplinks):
+    # Each uplink is a [metrics_data, coordinates, device_addr] triple, processed with shared DB handles
+    processed = 0
+    with gateway_database() as gw_db, device_database() as dev_db:
+        for metrics_data, coordinates, device_addr in uplinks:
+            try:
+                process_uplink(metrics_data, coordinates, device_addr, gw_db, dev_db)
+                processed += 1
             except Exception as e:
-                return str(e)
-            
+                logger.error(f"Error processing uplink {metrics_data}: {e}")
+    logger.info(f"Processed batch of {processed}/{len(uplinks)} uplinks")
+    return f"{processed} uplinks processed"
+
 @shared_task
-def dev_packet_rate_task():
-    device_list = []
-    uplink_interval = []
-    packet_rate = {}
-    with device_database() as db:
-        device_list += db.device_query()
-        uplink_interval += db.device_up_int_query()
-    for device in device_list:
-        query = f'''
-        from(bucket: "dev_metrics")
-        |> range(start: -15m)
-        |> filter(fn: (r) => r._measurement == "avg_device_metrics")
-        |> filter(fn: (r) => r.device_id == "{device[2]}")
-        |> filter(fn: (r) => r._field == "packet_rate")
-        '''
-        result = query_api.query(org=org, query=query)
-        # Extract the count value
-        if result is not None:
-            count = 0
-            for table in result:
-                for record in table.records:
-                    count += record.get_value()
-            packet_rate[device[2]] = int(count)
+def update_gateway_locations(updates):
+    """
+    Apply the positions collected by location_batcher, one [eui, lat, long, alt]
+    per gateway. A gateway without coordinates takes the reported ones; one
+    that moved further than LOCATION_SHIFT_TOLERANCE is moved and alerted on.
+    Addresses are resolved for new positions and for gateways without one,
+    and every change is written in one transaction.
+    """
+    with gateway_database() as db:
+        current = db.fetch_gateway_positions(update[0] for update in updates)
+    rows = []
+    shifts = []
+    for eui, lat, long, alt in updates:
+        if eui not in current:
+            continue
+        name, coordinates, address = current[eui]
+        stored = parse_coordinates(coordinates)
+        moved = stored is not None and distance_km(stored[0], stored[1], lat, long) * 1000 > LOCATION_SHIFT_TOLERANCE
+        if stored is not None and not moved and address:
+            continue
+        # Unresolved addresses are stored empty so the next report of the gateway retries them
+        if stored is None or moved:
+            coordinates = f'{lat},{long},{alt}'
+            address = rev_geocode(lat, long) or ''
         else:
-            packet_rate[device[2]] = 0
-                
-    for interval in uplink_interval:
-        if packet_rate[interval[1]] == 0:
-            with alert_database() as db:
-                logger.info(db.alert_write(interval[0], interval[1], 'Offline', 'No packets were sent in the last 15min', 'high'))
+            address = rev_geocode(*stored[:2])
+            if not address:
+                # Nothing changed, rewriting the row would only invalidate the gateway ETags
                 continue
-        else:
-            with alert_database() as db:
-                if db.check_alert_registered(interval[1], "Offline"):
-                        db.remove_alert(interval[1], "Offline")
-        if packet_rate[interval[1]] < (900//interval[2]):
-            with alert_database() as db:
-                logger.info(db.alert_write(interval[0], interval[1], "Packet Loss", f'{packet_rate[interval[1]]} Packets Recieved in the Last 15min', 'medium'))
-        elif packet_rate[interval[1]] > (900//interval[2]):
-            with alert_database() as db:
-                logger.info(db.alert_write(interval[0], interval[1], "Packet Flooding", f'{packet_rate[interval[1]]} Packets Recieved in the Last 15min', 'high'))
-        else:
-            with alert_database() as db:
-                logger.info("Packet Rate Optimum for " + interval[0])
-                if db.check_alert_registered(interval[1], "Packet Loss"):
-                    db.remove_alert(interval[1], "Packet Loss")
-                elif db.check_alert_registered(interval[1], "Packet Flooding"):
-                    db.remove_alert(interval[1], "Packet Flooding")
+        if moved:
+            shifts.append((name, eui, distance_km(stored[0], stored[1], lat, long) * 1000, stored, (lat, long, alt)))
+        rows.append((coordinates, address, eui))
+    with gateway_database() as db:
+        db.set_gateway_locations(rows)
+    if shifts:
+        with gw_alert_database() as db:
+            for name, eui, distance, old, new in shifts:
+                logger.info(db.alert_write(name, eui, 'Gateway Location Changed', f'Location of {name} has moved {distance:.0f} m from ({old[0]}, {old[1]}, {old[2]}) to ({new[0]}, {new[1]}, {new[2]})', 'critical'))
+    return f"{len(rows)} gateway locations updated"
 
-@shared_task
-def dev_signal_strength_task():
-    device_list = []
-    with device_database() as db:
-        device_list += db.device_query()
-    for device in device_list:
-        signal_values = {
-            'avg_rssi': None,
-            'avg_snr': None
+# Gateway positions are coalesced per process and sent to the 'location' queue at most once per window
+location_updates = location_batcher(
+    lambda updates: update_gateway_locations.apply_async(args=[updates], queue='location'),
+    delay=float(os.getenv('LOCATION_DEBOUNCE', 30))
+)
+
+def apply_detection(alert_db, rules, names, euis, metrics, kind):
+    # Collect the full desired alert set of this run and apply it in one transaction
+    desired = []
+    cleared = []
+    with alert_db() as db:
+        # Currently raised alerts, so rules with a clear threshold can apply hysteresis
+        current = db.active_alerts(rule['issue'] for rule in rules)
+        active = {
+            rule['issue']: np.fromiter(((eui, rule['issue']) in current for eui in euis), dtype=bool, count=len(euis))
+            for rule in rules
         }
-        query = f'''
-            from(bucket: "dev_metrics")
-            |> range(start: -1h)
-            |> filter(fn: (r) => r._measurement == "avg_device_metrics")
-            |> filter(fn: (r) => r.device_id == "{device[2]}")
-            |> filter(fn: (r) => r._field == "avg_rssi" or r._field == "avg_snr")  // RSSI Values and SNR
-        '''
-        result = query_api.query(org=org, query=query)
-        if result is not None:
-            for table in result:
-                sum = 0
-                count = 0
-                for record in table.records:
-                    sum += record.get_value()
-                    count += 1
-                if count == 0:
-                    with alert_database() as db:
-                        logger.info(db.alert_write(device[1], device[2], 'Offline', 'No packets were sent in the last 1hr', 'high'))
-                        continue
-                else:
-                    with alert_database() as db:
-                        if db.check_alert_registered(device[1], "Offline"):
-                                db.remove_alert(device[1], "Offline")
-                signal_values[record.get_field()] = sum/count
+        for rule, raised, evaluated in engine.evaluate(rules, euis, metrics, kind, active):
+            values = metrics[rule['metric']]
+            for i in np.flatnonzero(raised):
+                desired.append((names[i], euis[i], rule['issue'], format_message(rule, values[i].item()), rule['severity']))
+            if rule.get('clear', True):
+                cleared += [(euis[i], rule['issue']) for i in np.flatnonzero(evaluated & ~raised)]
+        policies = {rule['issue']: rule for rule in rules}
+        if kind == 'devices':
+            desired, root_causes = correlate_device_alerts(desired, rules)
+            return db.reconcile_alerts(desired, cleared, policies, root_causes)
+        return db.reconcile_alerts(desired, cleared, policies)
 
-        if signal_values["avg_rssi"] is not None and signal_values["avg_rssi"] < 100:
-            with alert_database() as db:
-                logger.info(db.alert_write(device[1], device[2], "Threshold Breach - RSSI", f'Average RSSI value is {signal_values["avg_rssi"]} in the last 1hr', 'medium'))
-        if signal_values["avg_snr"] is not None and signal_values["avg_snr"]< 100:
-            with alert_database() as db:
-                logger.info(db.alert_write(device[1], device[2], "Threshold Breach - SNR", f'Average SNR value is {signal_values["avg_snr"]} in the last 1hr', 'high'))
+def correlate_device_alerts(desired, rules):
+    """
+    Group device alerts of rules marked 'correlate' under the Offline alert of
+    the gateway the device is behind. Returns the desired alerts, with the
+    messages of correlated ones naming the gateway, and a dict of
+    (eui, issue) -> gateway EUI for the correlated alerts.
+    """
+    issues = {rule['issue'] for rule in rules if rule.get('correlate')}
+    if not issues or not desired:
+        return desired, {}
+    with gw_alert_database() as db:
+        offline = {eui for eui, issue in db.active_alerts(['Offline'])}
+    if not offline:
+        return desired, {}
+    root_causes = {}
+    correlated = []
+    for alert in desired:
+        device = registry.get_device(alert[1]) if alert[2] in issues else None
+        gw_id = device['gw_id'] if device else None
+        if gw_id in offline:
+            root_causes[(alert[1], alert[2])] = gw_id
+            gateway = registry.get_gateway(gw_id)
+            alert = alert[:3] + (f"{alert[3]} - gateway {gateway['name'] if gateway else gw_id} is offline",) + alert[4:]
+        correlated.append(alert)
+    return correlated, root_causes
 
+def signal_metrics(signal_quality, euis):
+    # Entities without signal data get NaN, which never breaches a threshold
+    missing = {'avg_rssi': None, 'avg_snr': None}
+    return {
+        field: np.array([signal_quality.get(eui, missing)[field] for eui in euis], dtype=float)
+        for field in ('avg_rssi', 'avg_snr')
+    }
 
+@shared_task
+def dev_packet_rate_task():
+    with device_database() as db:
+        uplink_interval = db.device_up_int_query() or []
+    # One grouped query for the whole fleet, devices without data in the window count as 0
+    rates = query_packet_rates(query_api, org, "dev_metrics", "avg_device_metrics", "device_id")
+    names = [interval[0] for interval in uplink_interval]
+    euis = [interval[1] for interval in uplink_interval]
+    metrics = {
+        'packet_rate': np.array([rates.get(eui, 0) for eui in euis], dtype=np.int64),
+        'expected_rate': np.array([900//interval[2] for interval in uplink_interval], dtype=np.int64)
+    }
+    apply_detection(alert_database, engine.rules('packet_rate_rules'), names, euis, metrics, 'devices')
+
+@shared_task
+def dev_signal_strength_task():
+    with device_database() as db:
+        device_list = db.device_query() or []
+    # Mean RSSI/SNR of every device, computed server side in a single query
+    signal_quality = query_signal_quality(query_api, org, "dev_metrics", "avg_device_metrics", "device_id")
+    names = [device[1] for device in device_list]
+    euis = [device[2] for device in device_list]
+    apply_detection(alert_database, engine.rules('signal_rules'), names, euis, signal_metrics(signal_quality, euis), 'devices')
 
 @shared_task
 def gw_packet_rate_task():
-    gateway_list = []
-    packet_rate = {}
     with gateway_database() as db:
-        gateway_list += db.gateway_query()
-    
+        gateway_list = db.gateway_query() or []
+    with device_database() as db:
+        expected_rate = dict(db.gateway_expected_rate_query() or [])
+    # One grouped query for every gateway, gateways without data in the window count as 0
+    rates = query_packet_rates(query_api, org, "gw_metrics", "avg_gateway_metrics", "gateway_id")
+    names = [gateway[1] for gateway in gateway_list]
+    euis = [gateway[2] for gateway in gateway_list]
+    metrics = {
+        'packet_rate': np.array([rates.get(eui, 0) for eui in euis], dtype=np.int64),
+        'expected_rate': np.array([expected_rate.get(eui) or 0 for eui in euis], dtype=np.int64)
+    }
+    apply_detection(gw_alert_database, engine.rules('packet_rate_rules'), names, euis, metrics, 'gateways')
 
-    for gateway in gateway_list:
-        query = f'''
-        from(bucket: "gw_metrics")
-        |> range(start: -15m)
-        |> filter(fn: (r) => r._measurement == "avg_gateway_metrics")
-        |> filter(fn: (r) => r.gateway_id == "{gateway[2]}")
-        |> filter(fn: (r) => r._field == "packet_rate")
-        '''
-        result = query_api.query(org=org, query=query)
-        # Extract the count value
-        if result is not None:
-            count = 0
-            for table in result:
-                for record in table.records:
-                    count += record.get_value()
-            packet_rate[gateway[2]] = int(count)
-        else:
-            packet_rate[gateway[2]] = 0
+@shared_task
+def packet_rate_task():
+    # Device alerts are correlated with the gateway Offline alerts, so the gateway run
+    # has to be reconciled first or the first cycle of an outage notifies every device
+    try:
+        gw_packet_rate_task()
+    except Exception as e:
+        logger.error(f"Error in gateway packet rate detection: {e}")
+    dev_packet_rate_task()
 
-    for gateway in gateway_list:
-        with device_database() as db:
-            uplink_intervals = db.gateway_up_int_query(gateway[2])
-        count = 0
-        for interval in uplink_intervals:
-            count += (3600//interval[0])
-        if packet_rate[gateway[2]] == 0:
-            with gw_alert_database() as db:
-                logger.info(db.alert_write(gateway[1], gateway[2], 'Offline', 'No packets were sent in the last 15min', 'high'))
-                continue
-        else:
-            with gw_alert_database() as db:
-                if db.check_alert_registered(gateway[2], "Offline"):
-                        db.remove_alert(gateway[2], "Offline")
-        if packet_rate[gateway[2]] < count:
-            with gw_alert_database() as db:
-                logger.info(db.alert_write(gateway[1], gateway[2], "Packet Loss", f'{packet_rate[gateway[2]]} Packets Recieved in the Last 15min', 'medium'))
-        elif packet_rate[gateway[2]] > count:
-            with gw_alert_database() as db:
-                logger.info(db.alert_write(gateway[1], gateway[2], "Packet Flooding", f'{packet_rate[gateway[2]]} Packets Recieved in the Last 15min', 'high'))
-        else:
-            with gw_alert_database() as db:
-                logger.info("Packet Rate Optimum for " + gateway[1])
-                if db.check_alert_registered(gateway[2], "Packet Loss"):
-                    db.remove_alert(gateway[2], "Packet Loss")
-                elif db.check_alert_registered(gateway[2], "Packet Flooding"):
-                    db.remove_alert(gateway[2], "Packet Flooding")
-        
 @shared_task
 def gw_signal_strength_task():
-    gateway_list = []
     with gateway_database() as db:
-        gateway_list += db.gateway_query()
-    for gateway in gateway_list:
-        signal_values = {
-            'avg_rssi': None,
-            'avg_snr': None
-        }
-        query = f'''
-            from(bucket: "gw_metrics")
-            |> range(start: -1h)
-            |> filter(fn: (r) => r._measurement == "avg_gateway_metrics")
-            |> filter(fn: (r) => r.gateway_id == "{gateway[2]}")
-            |> filter(fn: (r) => r._field == "avg_rssi" or r._field == "avg_snr")  // RSSI Values and SNR
-        '''
-        result = query_api.query(org=org, query=query)
-        if result is not None:
-            for table in result:
-                sum = 0
-                count = 0
-                for record in table.records:
-                    sum += record.get_value()
-                    count += 1
-                if count == 0:
-                    with gw_alert_database() as db:
-                        logger.info(db.alert_write(gateway[1], gateway[2], 'Offline', 'No packets were sent in the last 1hr', 'high'))
-                        continue
-                else:
-                    with gw_alert_database() as db:
-                        if db.check_alert_registered(gateway[1], "Offline"):
-                                db.remove_alert(gateway[1], "Offline")
-                signal_values[record.get_field()] = sum/count
-        if signal_values["avg_rssi"] is not None and signal_values["avg_rssi"] < 100:
-            with gw_alert_database() as db:
-                logger.info(db.alert_write(gateway[1], gateway[2], "Threshold Breach - RSSI", f'Average RSSI value is {signal_values["avg_rssi"]} in the last 1hr', 'medium'))
-        if signal_values["avg_snr"] is not None and signal_values["avg_snr"]< 100:
-            with gw_alert_database() as db:
-                logger.info(db.alert_write(gateway[1], gateway[2], "Threshold Breach - SNR", f"Average SNR value is {signal_values["avg_snr"]} in the last 1hr", 'high'))
+        gateway_list = db.gateway_query() or []
+    # Mean RSSI/SNR of every gateway, computed server side in a single query
+    signal_quality = query_signal_quality(query_api, org, "gw_metrics", "avg_gateway_metrics", "gateway_id")
+    names = [gateway[1] for gateway in gateway_list]
+    euis = [gateway[2] for gateway in gateway_list]
+    apply_detection(gw_alert_database, engine.rules('signal_rules'), names, euis, signal_metrics(signal_quality, euis), 'gateways')
+
+@shared_task
+def inventory_refresh_task():
+    # Keep the shared ChirpStack inventory snapshot current for /status_data and the dashboard
+    try:
+        return refresh_snapshot()
+    except Exception as e:
+        logger.error(f"Error refreshing inventory snapshot: {e}")
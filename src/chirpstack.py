@@ -0,0 +1,126 @@
+import os
+import json
+import threading
+import grpc
+from concurrent.futures import ThreadPoolExecutor
+from log import logger
+
+# Page size of List calls and the number of pages fetched in parallel
+PAGE_SIZE = int(os.getenv('CHIRPSTACK_PAGE_SIZE', 100))
+MAX_CONCURRENCY = int(os.getenv('CHIRPSTACK_MAX_CONCURRENCY', 8))
+
+# Keepalive pings keep idle connections to ChirpStack open, the backoff settings bound
+# how aggressively a dropped connection is re-established
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.initial_reconnect_backoff_ms', 1000),
+    ('grpc.min_reconnect_backoff_ms', 1000),
+    ('grpc.max_reconnect_backoff_ms', 30000),
+    ('grpc.enable_retries', 1),
+    ('grpc.service_config', json.dumps({
+        "methodConfig": [{
+            "name": [{}],
+            "retryPolicy": {
+                "maxAttempts": 3,
+                "initialBackoff": "0.2s",
+                "maxBackoff": "2s",
+                "backoffMultiplier": 2,
+                "retryableStatusCodes": ["UNAVAILABLE"]
+            }
+        }]
+    }))
+]
+
+
+class channel_manager:
+    """
+    Keeps one persistent gRPC channel per ChirpStack server and caches the
+    service stubs created on it. When CHIRPSTACK_SERVER changes, channels to
+    the previous server are closed as the new one is opened. gRPC channels
+    do not survive a fork, so each process builds its own.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.channels = {}
+        self.stubs = {}
+
+    def channel(self, target=None):
+        target = target or os.getenv('CHIRPSTACK_SERVER')
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.channels = {}
+                self.stubs = {}
+            channel = self.channels.get(target)
+            if channel is None:
+                # Channels to servers that are no longer configured are closed, not kept alive
+                for stale in [t for t in self.channels if t != os.getenv('CHIRPSTACK_SERVER')]:
+                    self.channels.pop(stale).close()
+                    self.stubs = {key: stub for key, stub in self.stubs.items() if key[0] != stale}
+                    logger.info(f"gRPC channel to ChirpStack at {stale} closed")
+                channel = grpc.insecure_channel(target, options=CHANNEL_OPTIONS)
+                self.channels[target] = channel
+                logger.info(f"gRPC channel opened to ChirpStack at {target}")
+            return channel
+
+    def stub(self, stub_cls, target=None):
+        target = target or os.getenv('CHIRPSTACK_SERVER')
+        channel = self.channel(target)
+        with self.lock:
+            stub = self.stubs.get((target, stub_cls))
+            if stub is None:
+                stub = self.stubs[(target, stub_cls)] = stub_cls(channel)
+            return stub
+
+    def close(self, target=None):
+        with self.lock:
+            targets = [target] if target else list(self.channels)
+            for t in targets:
+                channel = self.channels.pop(t, None)
+                if channel is not None:
+                    channel.close()
+                self.stubs = {key: stub for key, stub in self.stubs.items() if key[0] != t}
+
+manager = channel_manager()
+
+# Bounds the ChirpStack calls in flight across every pool of the process, so nested
+# fan-outs (tenants -> applications -> pages) stay within MAX_CONCURRENCY. Only the
+# call itself holds a slot, never a wait on other work, so nesting cannot deadlock.
+call_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+def get_stub(stub_cls, target=None):
+    return manager.stub(stub_cls, target)
+
+def auth_metadata(api_key=None):
+    api_token = api_key if api_key is not None else os.getenv('CHIRPSTACK_APIKEY')
+    return [("authorization", "Bearer %s" % api_token)]
+
+def call(method, req):
+    # Every ChirpStack RPC goes through here so it is counted against call_slots
+    with call_slots:
+        return method(req, metadata=auth_metadata())
+
+def paginate(method, request_cls, page_size=None, max_workers=None, **filters):
+    """
+    Iterate over every item of a ChirpStack List call.
+    The first page reports total_count, the remaining pages are then fetched
+    concurrently (at most max_workers at a time) and yielded in order.
+    """
+    page_size = page_size or PAGE_SIZE
+
+    def fetch(offset):
+        req = request_cls(limit=page_size, offset=offset, **filters)
+        return call(method, req)
+
+    first = fetch(0)
+    yield from first.result
+    offsets = range(page_size, first.total_count, page_size)
+    if len(offsets) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers or MAX_CONCURRENCY, len(offsets))) as executor:
+        for resp in executor.map(fetch, offsets):
+            yield from resp.result
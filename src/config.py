@@ -4,6 +4,7 @@ import requests
 import grpc
 from chirpstack_api import api
 from requests.auth import HTTPBasicAuth
+from chirpstack import auth_metadata
 from log import logger
 
 
@@ -47,12 +48,12 @@ def check_chirpstack_server_and_api(server_url, api_key):
     try:
         # Connect to ChirpStack gRPC server
         
-        channel = grpc.insecure_channel(server_url)
-        auth_token = [("authorization", "Bearer %s" % api_key)]
-        client = api.TenantServiceStub(channel)
-        req = api.ListTenantsRequest()
-        req.limit = 100 #mandatory if you want details
-        resp = client.List(req, metadata=auth_token)
+        # A throwaway channel, so probing arbitrary servers leaves no pooled connection behind
+        with grpc.insecure_channel(server_url) as channel:
+            client = api.TenantServiceStub(channel)
+            req = api.ListTenantsRequest()
+            req.limit = 100 #mandatory if you want details
+            resp = client.List(req, metadata=auth_metadata(api_key), timeout=10)
 
         # If we get a successful response, the server is reachable and API key is valid
         results["server_health"]["reachable"] = True
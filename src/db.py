@@ -1,15 +1,122 @@
+import os
+import json
 import sqlite3
+import threading
+import time
 import uuid
 import bcrypt
 from telegram_bot import send_telegram_alert
+from versions import counters
 from log import logger
 
+# Callbacks run after a device or gateway row is written, e.g. to invalidate caches
+write_listeners = []
+
+def on_write(callback):
+    write_listeners.append(callback)
+    return callback
+
+def notify_write(table, eui, **fields):
+    counters.bump(table)
+    for callback in write_listeners:
+        try:
+            callback(table, eui, **fields)
+        except Exception as e:
+            logger.error(f"Error in write listener for {table}: {e}")
+
+# Pragmas applied to every pooled connection: WAL lets readers and one writer work concurrently,
+# synchronous=NORMAL is durable under WAL while avoiding an fsync per commit
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA temp_store=MEMORY"
+)
+
+class connection_pool:
+    """
+    Long-lived SQLite connections, one per database file per thread.
+    Connections are never shared across threads or inherited across a fork,
+    and each database schema is initialized once per process.
+    """
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.initialized = set()
+        self.init_locks = {}
+
+    def connect(self, db_file):
+        if self.pid != os.getpid():
+            self._reset()
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        conn = connections.get(db_file)
+        if conn is None:
+            conn = sqlite3.connect(db_file, timeout=self.timeout)
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            connections[db_file] = conn
+        return conn
+
+    def initialize(self, db_file, init):
+        # Run the schema DDL once per process; other threads wait until it has committed
+        # instead of querying a fresh database before its tables exist
+        if db_file in self.initialized:
+            return
+        with self.lock:
+            init_lock = self.init_locks.setdefault(db_file, threading.Lock())
+        with init_lock:
+            if db_file not in self.initialized:
+                init()
+                self.initialized.add(db_file)
+
+    def close_all(self):
+        for conn in getattr(self.local, 'connections', {}).values():
+            conn.close()
+        self.local.connections = {}
+
+pool = connection_pool()
+
+def keyset_page(db, columns, source, conditions, params, sort, descending, after, limit):
+    """
+    One page of rows from source (aliased t) ordered by (sort, id), starting
+    after the (sort value, id) key of the previous page's last row. sort must
+    be a whitelisted, indexed column. Returns the rows and the key of the
+    last row, or None when there are no more rows.
+    """
+    conditions = list(conditions)
+    params = list(params)
+    if after is not None:
+        conditions.append(f"(t.{sort}, t.id) {'<' if descending else '>'} (?, ?)")
+        params += list(after)
+    direction = 'DESC' if descending else 'ASC'
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    db.cursor.execute(f"""
+    SELECT {columns}, t.{sort}, t.id FROM {source}
+    {where}
+    ORDER BY t.{sort} {direction}, t.id {direction}
+    LIMIT ?
+    """, params + [limit + 1])
+    rows = db.cursor.fetchall()
+    last = (rows[limit - 1][-2], rows[limit - 1][-1]) if len(rows) > limit else None
+    return [row[:-2] for row in rows[:limit]], last
+
+def prefix_condition(column, prefix):
+    # Range form of a prefix match so the index on column can be used
+    return f"{column} >= ? AND {column} < ?", [prefix, prefix + '\U0010ffff']
+
 class user_database:
     db_file = "user.db"
     def __init__(self):
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = pool.connect(self.db_file)
         self.cursor = self.conn.cursor()
-        self.initialize_user_db()
+        pool.initialize(self.db_file, self.initialize_user_db)
 
     def initialize_user_db(self):   
         # Create a table if it doesn't exist
@@ -120,11 +227,12 @@ class user_database:
         else:
             return False
     
-    # Destroyer method to close the connection
+    # Release the cursor, the connection stays open in the pool
     def close(self):
         if self.conn:
             self.cursor.close()
-            self.conn.close()
+            if self.conn.in_transaction:
+                self.conn.rollback()
 
     def __enter__(self):
         return self
@@ -136,9 +244,9 @@ class user_database:
 class gateway_database:
     db_file = "storage/gateway.db"
     def __init__(self):
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = pool.connect(self.db_file)
         self.cursor = self.conn.cursor()
-        self.initialize_gateway_db()
+        pool.initialize(self.db_file, self.initialize_gateway_db)
 
     def initialize_gateway_db(self):   
         # Create a table if it doesn't exist
@@ -154,6 +262,11 @@ class gateway_database:
             UNIQUE(name, eui)
         )
         """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS gateway_eui ON gateway (eui)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS gateway_uid ON gateway (uid)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS gateway_name ON gateway (name)")
+        # Unresolved addresses used to be stored as this placeholder text, they are kept empty so they are retried
+        self.cursor.execute("UPDATE gateway SET address = '' WHERE address = 'Location information not available'")
         self.conn.commit()
     
     # Fetch gateway_location from the database
@@ -221,6 +334,7 @@ class gateway_database:
             WHERE eui = ?
             """, (location, eui)) 
             self.conn.commit()  # Commit the changes to the database
+            notify_write('gateway', eui, address=location)
         except sqlite3.Error as e:
             logger.error(f"Error saving to DB: {e}")
 
@@ -233,6 +347,34 @@ class gateway_database:
             WHERE eui = ?
             """, (coordinates, eui)) 
             self.conn.commit()  # Commit the changes to the database
+            notify_write('gateway', eui, coordinates=coordinates)
+        except sqlite3.Error as e:
+            logger.error(f"Error saving to DB: {e}")
+
+    # Name, coordinates and address of the given gateways, keyed by EUI
+    def fetch_gateway_positions(self, euis):
+        euis = list(euis)
+        if not euis:
+            return {}
+        self.cursor.execute(f"""
+        SELECT eui, name, coordinates, address FROM gateway
+        WHERE eui IN ({', '.join('?' * len(euis))})
+        """, euis)
+        return {row[0]: row[1:] for row in self.cursor.fetchall()}
+
+    # Set the coordinates and address of many gateways in one transaction, rows are (coordinates, address, eui)
+    def set_gateway_locations(self, rows):
+        if not rows:
+            return
+        try:
+            self.cursor.executemany("""
+            UPDATE gateway
+            SET coordinates = ?, address = ?
+            WHERE eui = ?
+            """, rows)
+            self.conn.commit()
+            for coordinates, address, eui in rows:
+                notify_write('gateway', eui, coordinates=coordinates, address=address)
         except sqlite3.Error as e:
             logger.error(f"Error saving to DB: {e}")
 
@@ -247,6 +389,7 @@ class gateway_database:
                 VALUES (?, ?, ?, ?, ?, ?)
                 """, (name, eui, address, sim_number, coordinates, unique_id))
                 self.conn.commit()
+                notify_write('gateway', eui)
                 return "Gateway Registered"
             except sqlite3.Error as e:
                 logger.error(f"Error saving to DB: {e}")
@@ -262,13 +405,29 @@ class gateway_database:
             return result
         except sqlite3.Error as e:
             logger.error(f"Error retrieving from DB: {e}")
+
+    sortable = ('id', 'name', 'eui')
+
+    def gateway_page(self, name=None, sort='id', descending=False, after=None, limit=100):
+        # A page of gateway rows (same shape as gateway_query), optionally filtered by name prefix
+        conditions, params = [], []
+        if name:
+            condition, values = prefix_condition('t.name', name)
+            conditions.append(condition)
+            params += values
+        try:
+            return keyset_page(self, "t.*", "gateway t", conditions, params, sort, descending, after, limit)
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving from DB: {e}")
+            return [], None
         
 
-    # Destroyer method to close the connection
+    # Release the cursor, the connection stays open in the pool
     def close(self):
         if self.conn:
             self.cursor.close()
-            self.conn.close()
+            if self.conn.in_transaction:
+                self.conn.rollback()
 
     def __enter__(self):
         return self
@@ -281,9 +440,9 @@ class gateway_database:
 class device_database:
     db_file = "storage/device.db"
     def __init__(self):
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = pool.connect(self.db_file)
         self.cursor = self.conn.cursor()
-        self.initialize_device_db()
+        pool.initialize(self.db_file, self.initialize_device_db)
 
     def initialize_device_db(self):
         
@@ -300,6 +459,10 @@ class device_database:
             UNIQUE(name, eui)
         )
         """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS device_eui ON device (eui)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS device_uid ON device (uid)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS device_gw_id ON device (gw_id)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS device_name ON device (name)")
         self.conn.commit()
     
     
@@ -332,6 +495,7 @@ class device_database:
             WHERE eui = ?
             """, (dev_addr, eui)) 
             self.conn.commit()  # Commit the changes to the database
+            notify_write('device', eui, dev_addr=dev_addr)
         except sqlite3.Error as e:
             logger.error(f"Error saving to DB: {e}")
 
@@ -355,6 +519,7 @@ class device_database:
             WHERE eui = ?
             """, (gw_id, eui)) 
             self.conn.commit()  # Commit the changes to the database
+            notify_write('device', eui, gw_id=gw_id)
         except sqlite3.Error as e:
             logger.error(f"Error saving to DB: {e}")
 
@@ -402,6 +567,7 @@ class device_database:
                 VALUES (?, ?, ?, ?, ?, ?)
                 """, (name, eui, gw_id, dev_addr, uplink_interval, unique_id))
                 self.conn.commit()
+                notify_write('device', eui)
                 return "Device Registered"
             except sqlite3.Error as e:
                 logger.error(f"Error saving to DB: {e}")
@@ -417,6 +583,24 @@ class device_database:
             return result
         except sqlite3.Error as e:
             logger.error(f"Error retrieving from DB: {e}")
+
+    sortable = ('id', 'name', 'eui')
+
+    def device_page(self, gateway=None, name=None, sort='id', descending=False, after=None, limit=100):
+        # A page of device rows (same shape as device_query), optionally filtered by gateway EUI and name prefix
+        conditions, params = [], []
+        if gateway:
+            conditions.append("t.gw_id = ?")
+            params.append(gateway)
+        if name:
+            condition, values = prefix_condition('t.name', name)
+            conditions.append(condition)
+            params += values
+        try:
+            return keyset_page(self, "t.*", "device t", conditions, params, sort, descending, after, limit)
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving from DB: {e}")
+            return [], None
     
     def device_up_int_query(self):
         try:
@@ -428,6 +612,18 @@ class device_database:
         except sqlite3.Error as e:
             logger.error(f"Error retrieving from DB: {e}")
         
+    def gateway_expected_rate_query(self):
+        # Expected hourly packet count of every gateway, summed over the devices behind it
+        try:
+            self.cursor.execute("""
+            SELECT gw_id, SUM(3600 / uplink_interval) FROM device
+            GROUP BY gw_id
+            """)
+            result = self.cursor.fetchall()
+            return result
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving from DB: {e}")
+
     def gateway_up_int_query(self, gw_id):
         try:
             self.cursor.execute("""
@@ -439,11 +635,12 @@ class device_database:
         except sqlite3.Error as e:
             logger.error(f"Error retrieving from DB: {e}")
     
-    # Destroyer method to close the connection
+    # Release the cursor, the connection stays open in the pool
     def close(self):
         if self.conn:
             self.cursor.close()
-            self.conn.close()
+            if self.conn.in_transaction:
+                self.conn.rollback()
 
     def __enter__(self):
         return self
@@ -451,12 +648,233 @@ class device_database:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+# Half-life (seconds) of an alert's flap score unless its rule sets flap_window
+DEFAULT_FLAP_WINDOW = 3600
+# State of alerts that stayed cleared and quiet is dropped once its flap score falls below this
+FLAP_SCORE_FLOOR = 0.05
+# State not touched by a detection run for this long (seconds) belongs to removed entities
+STATE_RETENTION = 86400
+
+# Number of alert events kept for clients catching up after a reconnect
+EVENT_LOG_SIZE = int(os.getenv('ALERT_EVENT_LOG_SIZE', 1000))
+ALERT_FIELDS = ('name', 'eui', 'issue', 'message', 'severity', 'uid')
+
+def initialize_alert_events(cursor):
+    # Every insert, update and delete of an alert is appended here in the same transaction,
+    # so the /events stream can never run ahead of or behind the alert table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS alert_event (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        op TEXT NOT NULL,
+        data TEXT NOT NULL
+    )
+    """)
+
+def record_alert_events(cursor, op, alerts):
+    # alerts are (name, eui, issue, message, severity, uid) tuples, 'reset' takes none
+    rows = [(op, json.dumps(dict(zip(ALERT_FIELDS, alert)))) for alert in alerts] if op != 'reset' else [(op, '{}')]
+    if not rows:
+        return
+    cursor.executemany("INSERT INTO alert_event (op, data) VALUES (?, ?)", rows)
+    cursor.execute("DELETE FROM alert_event WHERE id <= (SELECT MAX(id) FROM alert_event) - ?", (EVENT_LOG_SIZE,))
+
+def initialize_root_cause(cursor):
+    # Older alert tables predate the root_cause column
+    cursor.execute("PRAGMA table_info(alert)")
+    if 'root_cause' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE alert ADD COLUMN root_cause TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS alert_root_cause ON alert (root_cause)")
+
+def initialize_alert_state(cursor):
+    # Condition state kept next to the alert rows: when the condition was last raised,
+    # a decaying count of raise/clear transitions and whether the alert is flapping
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS alert_state (
+        eui TEXT NOT NULL,
+        issue TEXT NOT NULL,
+        active INTEGER NOT NULL,
+        since REAL NOT NULL,
+        score REAL NOT NULL,
+        flapping INTEGER NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (eui, issue)
+    )
+    """)
+
+def reconcile_alert_table(db, desired, cleared, policies=None, label="Alerts", root_causes=None):
+    """
+    Apply the outcome of a detection run to db's alert table in a single transaction.
+    desired holds (name, eui, issue, message, severity) for every alert that
+    should be active, cleared holds (eui, issue) for alerts that should not.
+    policies maps an issue to its rule, whose optional min_hold (seconds an
+    alert stays up after being raised), flap_threshold and flap_window
+    (half-life of the transition count) damp noisy alerts. A flapping alert
+    is neither cleared nor notified until its transition count decays below
+    half the threshold.
+    root_causes maps (eui, issue) to the EUI of the entity whose alert
+    explains it; such alerts are stored with that root_cause and are not
+    notified individually.
+    Returns (inserted, notify): the newly inserted alerts and those of them
+    that should be notified.
+    """
+    policies = policies or {}
+    root_causes = root_causes or {}
+    issues = {alert[2] for alert in desired} | {alert[1] for alert in cleared}
+    if not issues:
+        return [], []
+    now = time.time()
+    placeholders = ', '.join('?' * len(issues))
+    try:
+        db.cursor.execute("BEGIN IMMEDIATE")
+        db.cursor.execute(f"""
+        SELECT eui, issue, message, root_cause, name, severity, uid FROM alert
+        WHERE issue IN ({placeholders})
+        """, tuple(issues))
+        rows = db.cursor.fetchall()
+        current = {(row[0], row[1]): (row[2], row[3]) for row in rows}
+        records = {(row[0], row[1]): (row[4], row[0], row[1], row[2], row[5], row[6]) for row in rows}
+        db.cursor.execute(f"""
+        SELECT eui, issue, active, since, score, flapping, updated_at FROM alert_state
+        WHERE issue IN ({placeholders})
+        """, tuple(issues))
+        state = {(row[0], row[1]): list(row[2:]) for row in db.cursor.fetchall()}
+
+        def observe(key, active):
+            entry = state.get(key)
+            if entry is None:
+                if not active:
+                    return None
+                entry = state[key] = [0, now, 0.0, 0, now]
+            policy = policies.get(key[1], {})
+            score = entry[2] * 0.5 ** ((now - entry[4]) / policy.get('flap_window', DEFAULT_FLAP_WINDOW))
+            if entry[0] != active:
+                score += 1
+                entry[0] = active
+                if active:
+                    entry[1] = now
+            entry[2], entry[4] = score, now
+            threshold = policy.get('flap_threshold')
+            if threshold and not entry[3] and score >= threshold:
+                entry[3] = 1
+                logger.warning(f"{label} - {key[0]} - {key[1]} is flapping, holding the alert and suppressing notifications")
+            elif entry[3] and (not threshold or score < threshold / 2):
+                entry[3] = 0
+                logger.info(f"{label} - {key[0]} - {key[1]} stopped flapping")
+            return entry
+
+        for alert in desired:
+            observe((alert[1], alert[2]), 1)
+        deletes = []
+        for key in cleared:
+            entry = observe(key, 0)
+            if key not in current:
+                continue
+            # Alerts raised before state was tracked have no entry and clear right away
+            if entry is not None and (entry[3] or now - entry[1] < policies.get(key[1], {}).get('min_hold', 0)):
+                continue
+            deletes.append(key)
+
+        inserts = [alert for alert in desired if (alert[1], alert[2]) not in current]
+        updates = [
+            (alert[3], root_causes.get((alert[1], alert[2])), alert[1], alert[2]) for alert in desired
+            if (alert[1], alert[2]) in current and current[(alert[1], alert[2])] != (alert[3], root_causes.get((alert[1], alert[2])))
+        ]
+        notify = [alert for alert in inserts if not state[(alert[1], alert[2])][3] and (alert[1], alert[2]) not in root_causes]
+        inserted = [alert + (str(uuid.uuid4()),) for alert in inserts]
+        db.cursor.executemany("""
+        INSERT INTO alert (name, eui, issue, message, severity, uid, root_cause)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [alert + (root_causes.get((alert[1], alert[2])),) for alert in inserted])
+        db.cursor.executemany("""
+        UPDATE alert
+        SET message = ?, root_cause = ?
+        WHERE eui = ? and issue = ?
+        """, updates)
+        db.cursor.executemany("""
+        DELETE FROM alert WHERE eui = ? AND issue = ?
+        """, deletes)
+        record_alert_events(db.cursor, 'insert', inserted)
+        record_alert_events(db.cursor, 'update', [records[(update[2], update[3])][:3] + (update[0],) + records[(update[2], update[3])][4:] for update in updates])
+        record_alert_events(db.cursor, 'delete', [records[key] for key in deletes])
+        remaining = set(current) - set(deletes)
+        # Drop state that has gone quiet, or whose entity is no longer evaluated at all
+        stale = [key for key, entry in state.items() if key not in remaining and not entry[3] and ((not entry[0] and entry[2] < FLAP_SCORE_FLOOR) or now - entry[4] > STATE_RETENTION)]
+        db.cursor.executemany("""
+        INSERT INTO alert_state (eui, issue, active, since, score, flapping, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (eui, issue) DO UPDATE SET
+            active = excluded.active, since = excluded.since, score = excluded.score,
+            flapping = excluded.flapping, updated_at = excluded.updated_at
+        """, [key + tuple(entry) for key, entry in state.items() if entry[4] == now and key not in stale])
+        db.cursor.executemany("""
+        DELETE FROM alert_state WHERE eui = ? AND issue = ?
+        """, stale)
+        db.conn.commit()
+        if inserts or updates or deletes:
+            counters.bump(db.counter)
+        logger.info(f"{label} Reconciled - {len(inserts)} raised, {len(updates)} updated, {len(deletes)} cleared, {len(inserts) - len(notify)} not notified")
+    except sqlite3.Error as e:
+        db.conn.rollback()
+        logger.error(f"Error saving to DB: {e}")
+        return [], []
+    return inserts, notify
+
+def active_alert_keys(db, issues):
+    # (eui, issue) of every alert currently raised for the given issues
+    issues = tuple(set(issues))
+    if not issues:
+        return set()
+    db.cursor.execute(f"""
+    SELECT eui, issue FROM alert
+    WHERE issue IN ({', '.join('?' * len(issues))})
+    """, issues)
+    return {(row[0], row[1]) for row in db.cursor.fetchall()}
+
+# Device alert rows with the gateway name of each device, resolved through the attached device and gateway databases
+DEVICE_ALERT_COLUMNS = """t.name,
+    COALESCE((
+        SELECT g.name FROM gw.gateway g
+        WHERE g.eui = (SELECT d.gw_id FROM dev.device d WHERE d.eui = t.eui LIMIT 1)
+        LIMIT 1
+    ), 'Unknown'),
+    t.issue, t.message, t.severity, t.uid"""
+
+def alert_filters(severity=None, issue=None, name=None):
+    conditions, params = [], []
+    if severity:
+        conditions.append("t.severity = ?")
+        params.append(severity)
+    if issue:
+        conditions.append("t.issue = ?")
+        params.append(issue)
+    if name:
+        condition, values = prefix_condition('t.name', name)
+        conditions.append(condition)
+        params += values
+    return conditions, params
+
+def fetch_alert_events(db, after, limit=500):
+    # Oldest first: (id, op, data) of the events logged after the given id
+    db.cursor.execute("""
+    SELECT id, op, data FROM alert_event
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+    """, (after, limit))
+    return db.cursor.fetchall()
+
+def alert_event_bounds(db):
+    # (oldest, newest) id still in the event log, (0, 0) when it is empty
+    db.cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM alert_event")
+    return db.cursor.fetchone()
+
 class alert_database:
     db_file = "storage/alert.db"
+    counter = "alert"
     def __init__(self):
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = pool.connect(self.db_file)
         self.cursor = self.conn.cursor()
-        self.initialize_alert_db()
+        pool.initialize(self.db_file, self.initialize_alert_db)
 
     def initialize_alert_db(self):    
         # Create a table if it doesn't exist
@@ -471,17 +889,35 @@ class alert_database:
             uid TEXT NOT NULL
         )
         """)
+        # Drop duplicate (eui, issue) rows left by older versions before enforcing uniqueness
+        self.cursor.execute("""
+        DELETE FROM alert WHERE id NOT IN (
+            SELECT MIN(id) FROM alert GROUP BY eui, issue
+        )
+        """)
+        self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS alert_eui_issue ON alert (eui, issue)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS alert_uid ON alert (uid)")
+        # Sort keys of the paginated alert endpoints
+        for column in ('name', 'severity', 'issue'):
+            self.cursor.execute(f"CREATE INDEX IF NOT EXISTS alert_{column} ON alert ({column})")
+        initialize_root_cause(self.cursor)
+        initialize_alert_state(self.cursor)
+        initialize_alert_events(self.cursor)
         self.conn.commit()
 
     def clear_alert_table(self):
         # Delete all records from the alert table
         self.cursor.execute("DELETE FROM alert")
+        self.cursor.execute("DELETE FROM alert_state")
         
         # Optionally, reset the auto-increment counter (if you want to start fresh from 1)
         self.cursor.execute("DELETE FROM sqlite_sequence WHERE name='alert'")
+        # Tell connected dashboards to reload their alert lists
+        record_alert_events(self.cursor, 'reset', [])
 
         # Commit changes
         self.conn.commit()
+        counters.bump(self.counter)
 
 
     # Check if Alert is the database
@@ -502,30 +938,64 @@ class alert_database:
         result = self.cursor.fetchone()
         return result is not None
 
-     # Save alert to the database
+     # Save alert to the database, or refresh its message if (eui, issue) is already registered
     def alert_write(self, name, eui, issue, message, severity):
-        
-        if not self.check_alert_registered(eui, issue):
-            try:
-                unique_id = str(uuid.uuid4())
-                self.cursor.execute("""
-                INSERT OR IGNORE INTO alert (name, eui, issue, message, severity, uid)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """, (name, eui, issue, message, severity, unique_id))
-                self.conn.commit()
-                send_telegram_alert(name, eui, issue, message, severity)
-                return f"Alert Registered - {name} - {issue} - {message}"
-            except sqlite3.Error as e:
-                logger.error(f"Error saving to DB: {e}")
-        else:
+        try:
+            unique_id = str(uuid.uuid4())
             self.cursor.execute("""
-            UPDATE alert
-            SET message = ?
-            WHERE eui = ? and issue = ?
-            """, (message, eui, issue)) 
+            INSERT INTO alert (name, eui, issue, message, severity, uid)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (eui, issue) DO UPDATE SET message = excluded.message
+            RETURNING uid
+            """, (name, eui, issue, message, severity, unique_id))
+            # The generated uid only comes back when the row was inserted rather than updated
+            uid = self.cursor.fetchall()[0][0]
+            inserted = uid == unique_id
+            record_alert_events(self.cursor, 'insert' if inserted else 'update', [(name, eui, issue, message, severity, uid)])
             self.conn.commit()
-            return f"Alert Already Registered - {name} - {issue} - {message}"
+            counters.bump(self.counter)
+        except sqlite3.Error as e:
+            logger.error(f"Error saving to DB: {e}")
+            return
+        if inserted:
+            send_telegram_alert(name, eui, issue, message, severity)
+            return f"Alert Registered - {name} - {issue} - {message}"
+        return f"Alert Already Registered - {name} - {issue} - {message}"
     
+    def reconcile_alerts(self, desired, cleared, policies=None, root_causes=None):
+        """
+        Apply the outcome of a detection run in a single transaction, see
+        reconcile_alert_table. New alerts grouped under a gateway's root-cause
+        alert are announced with one summary per gateway instead of one
+        message each. Returns the list of newly inserted alerts.
+        """
+        inserts, notify = reconcile_alert_table(self, desired, cleared, policies, "Alerts", root_causes)
+        for alert in notify:
+            send_telegram_alert(*alert)
+        # Only newly raised alerts are summarized; alerts already announced before their
+        # gateway went offline are regrouped by the root_cause update and stay silent
+        grouped = {}
+        for alert in inserts:
+            root_cause = (root_causes or {}).get((alert[1], alert[2]))
+            if root_cause is not None:
+                grouped.setdefault(root_cause, []).append(alert)
+        if grouped:
+            with gateway_database() as db:
+                for gateway_eui, alerts in grouped.items():
+                    issues = ', '.join(sorted({alert[2] for alert in alerts}))
+                    send_telegram_alert(db.fetch_gateway_name(gateway_eui), gateway_eui, "Device Alerts Grouped",
+                                        f"{len(alerts)} device alerts ({issues}) are attributed to this gateway being offline", 'high', True)
+        return inserts
+
+    def active_alerts(self, issues):
+        return active_alert_keys(self, issues)
+
+    def alert_events(self, after, limit=500):
+        return fetch_alert_events(self, after, limit)
+
+    def alert_event_bounds(self):
+        return alert_event_bounds(self)
+
     def query_alert(self, eui = None):
         if eui is not None:
             try:
@@ -563,15 +1033,66 @@ class alert_database:
         result = self.cursor.fetchall()
         return result
 
+    def attach_inventory(self):
+        # The device and gateway databases are attached once per pooled connection
+        self.cursor.execute("PRAGMA database_list")
+        attached = {row[1] for row in self.cursor.fetchall()}
+        for alias, database in (('dev', device_database), ('gw', gateway_database)):
+            if alias not in attached:
+                # Make sure the schema exists before its tables are referenced
+                with database():
+                    pass
+                self.cursor.execute("ATTACH DATABASE ? AS " + alias, (database.db_file,))
+
+    def query_alert_view(self, eui=None):
+        """
+        Device alerts as (name, gateway name, issue, message, severity, uid),
+        resolving each device's gateway name in the same query through the
+        attached device and gateway databases (indexed lookups on eui).
+        """
+        try:
+            self.attach_inventory()
+            self.cursor.execute(f"""
+            SELECT {DEVICE_ALERT_COLUMNS}
+            FROM alert t
+            {"WHERE t.eui = ?" if eui is not None else ""}
+            """, (eui,) if eui is not None else ())
+            return self.cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving from DB: {e}")
+            return []
+
+    sortable = ('id', 'name', 'severity', 'issue')
+
+    def query_alert_page(self, severity=None, issue=None, gateway=None, name=None, sort='id', descending=False, after=None, limit=100):
+        """
+        A page of device alerts in the query_alert_view shape, optionally
+        filtered by severity, issue, gateway EUI and device name prefix.
+        """
+        conditions, params = alert_filters(severity, issue, name)
+        if gateway:
+            conditions.append("t.eui IN (SELECT d.eui FROM dev.device d WHERE d.gw_id = ?)")
+            params.append(gateway)
+        try:
+            self.attach_inventory()
+            return keyset_page(self, DEVICE_ALERT_COLUMNS, "alert t", conditions, params, sort, descending, after, limit)
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving from DB: {e}")
+            return [], None
+
 
     def delete_alert(self, uid):
         try:
             self.cursor.execute("""
             DELETE FROM alert WHERE uid = ?
+            RETURNING name, eui, issue, message, severity, uid
             """, (uid, ))
+            removed = self.cursor.fetchall()
+            record_alert_events(self.cursor, 'delete', removed)
             self.conn.commit()
             
-            if self.cursor.rowcount > 0:
+            if removed:
+                counters.bump(self.counter)
                 return "Alert Removed"
             else:
                 return "Alert Not Found"
@@ -583,10 +1104,14 @@ class alert_database:
         try:
             self.cursor.execute("""
             DELETE FROM alert WHERE eui = ? AND issue = ?
+            RETURNING name, eui, issue, message, severity, uid
             """, (eui, issue))
+            removed = self.cursor.fetchall()
+            record_alert_events(self.cursor, 'delete', removed)
             self.conn.commit()
             
-            if self.cursor.rowcount > 0:
+            if removed:
+                counters.bump(self.counter)
                 return "Alert Removed"
             else:
                 return "Alert Not Found"
@@ -594,11 +1119,12 @@ class alert_database:
             logger.error(f"Error removing from DB: {e}")
             return "Error occurred"
 
-        # Destroyer method to close the connection
+        # Release the cursor, the connection stays open in the pool
     def close(self):
         if self.conn:
             self.cursor.close()
-            self.conn.close()
+            if self.conn.in_transaction:
+                self.conn.rollback()
 
     def __enter__(self):
         return self
@@ -609,10 +1135,11 @@ class alert_database:
 
 class gw_alert_database:
     db_file = "storage/gw_alert.db"
+    counter = "gw_alert"
     def __init__(self):
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = pool.connect(self.db_file)
         self.cursor = self.conn.cursor()
-        self.initialize_alert_db()
+        pool.initialize(self.db_file, self.initialize_alert_db)
 
     def initialize_alert_db(self):    
         # Create a table if it doesn't exist
@@ -627,17 +1154,35 @@ class gw_alert_database:
             uid TEXT NOT NULL
         )
         """)
+        # Drop duplicate (eui, issue) rows left by older versions before enforcing uniqueness
+        self.cursor.execute("""
+        DELETE FROM alert WHERE id NOT IN (
+            SELECT MIN(id) FROM alert GROUP BY eui, issue
+        )
+        """)
+        self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS alert_eui_issue ON alert (eui, issue)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS alert_uid ON alert (uid)")
+        # Sort keys of the paginated alert endpoints
+        for column in ('name', 'severity', 'issue'):
+            self.cursor.execute(f"CREATE INDEX IF NOT EXISTS alert_{column} ON alert ({column})")
+        initialize_root_cause(self.cursor)
+        initialize_alert_state(self.cursor)
+        initialize_alert_events(self.cursor)
         self.conn.commit()
 
     def clear_alert_table(self):
         # Delete all records from the alert table
         self.cursor.execute("DELETE FROM alert")
+        self.cursor.execute("DELETE FROM alert_state")
         
         # Optionally, reset the auto-increment counter (if you want to start fresh from 1)
         self.cursor.execute("DELETE FROM sqlite_sequence WHERE name='alert'")
+        # Tell connected dashboards to reload their alert lists
+        record_alert_events(self.cursor, 'reset', [])
 
         # Commit changes
         self.conn.commit()
+        counters.bump(self.counter)
 
 
     # Check if Alert is the database
@@ -658,30 +1203,49 @@ class gw_alert_database:
         result = self.cursor.fetchone()
         return result is not None
 
-     # Save alert to the database
+     # Save alert to the database, or refresh its message if (eui, issue) is already registered
     def alert_write(self, name, eui, issue, message, severity):
-        
-        if not self.check_alert_registered(eui, issue):
-            try:
-                unique_id = str(uuid.uuid4())
-                self.cursor.execute("""
-                INSERT OR IGNORE INTO alert (name, eui, issue, message, severity, uid)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """, (name, eui, issue, message, severity, unique_id))
-                self.conn.commit()
-                send_telegram_alert(name, eui, issue, message, severity, True)
-                return f"GW-Alert Registered - {name} - {issue} - {message}"
-            except sqlite3.Error as e:
-                logger.error(f"Error saving to DB: {e}")
-        else:
+        try:
+            unique_id = str(uuid.uuid4())
             self.cursor.execute("""
-            UPDATE alert
-            SET message = ?
-            WHERE eui = ? and issue = ?
-            """, (message, eui, issue)) 
+            INSERT INTO alert (name, eui, issue, message, severity, uid)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (eui, issue) DO UPDATE SET message = excluded.message
+            RETURNING uid
+            """, (name, eui, issue, message, severity, unique_id))
+            # The generated uid only comes back when the row was inserted rather than updated
+            uid = self.cursor.fetchall()[0][0]
+            inserted = uid == unique_id
+            record_alert_events(self.cursor, 'insert' if inserted else 'update', [(name, eui, issue, message, severity, uid)])
             self.conn.commit()
-            return f"GW-Alert Already Registered - {name} - {issue} - {message}"
+            counters.bump(self.counter)
+        except sqlite3.Error as e:
+            logger.error(f"Error saving to DB: {e}")
+            return
+        if inserted:
+            send_telegram_alert(name, eui, issue, message, severity, True)
+            return f"GW-Alert Registered - {name} - {issue} - {message}"
+        return f"GW-Alert Already Registered - {name} - {issue} - {message}"
     
+    def reconcile_alerts(self, desired, cleared, policies=None):
+        """
+        Apply the outcome of a detection run in a single transaction, see
+        reconcile_alert_table. Returns the list of newly inserted alerts.
+        """
+        inserts, notify = reconcile_alert_table(self, desired, cleared, policies, "GW-Alerts")
+        for alert in notify:
+            send_telegram_alert(*alert, True)
+        return inserts
+
+    def active_alerts(self, issues):
+        return active_alert_keys(self, issues)
+
+    def alert_events(self, after, limit=500):
+        return fetch_alert_events(self, after, limit)
+
+    def alert_event_bounds(self):
+        return alert_event_bounds(self)
+
     def query_alert(self, eui = None):
         if eui is not None:
             try:
@@ -711,6 +1275,23 @@ class gw_alert_database:
         result = self.cursor.fetchone()
         return result[0] if result else "Unknown"
 
+    sortable = ('id', 'name', 'severity', 'issue')
+
+    def query_alert_page(self, severity=None, issue=None, gateway=None, name=None, sort='id', descending=False, after=None, limit=100):
+        """
+        A page of gateway alerts as (name, issue, message, severity, uid),
+        optionally filtered by severity, issue, gateway EUI and name prefix.
+        """
+        conditions, params = alert_filters(severity, issue, name)
+        if gateway:
+            conditions.append("t.eui = ?")
+            params.append(gateway)
+        try:
+            return keyset_page(self, "t.name, t.issue, t.message, t.severity, t.uid", "alert t", conditions, params, sort, descending, after, limit)
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving from DB: {e}")
+            return [], None
+
     def get_gw_alerts(self, eui):
         self.cursor.execute("""
         SELECT * FROM alert
@@ -724,10 +1305,14 @@ class gw_alert_database:
         try:
             self.cursor.execute("""
             DELETE FROM alert WHERE uid = ?
+            RETURNING name, eui, issue, message, severity, uid
             """, (uid, ))
+            removed = self.cursor.fetchall()
+            record_alert_events(self.cursor, 'delete', removed)
             self.conn.commit()
             
-            if self.cursor.rowcount > 0:
+            if removed:
+                counters.bump(self.counter)
                 return "GW Alert Removed"
             else:
                 return "GW Alert Not Found"
@@ -739,10 +1324,14 @@ class gw_alert_database:
         try:
             self.cursor.execute("""
             DELETE FROM alert WHERE eui = ? AND issue = ?
+            RETURNING name, eui, issue, message, severity, uid
             """, (eui, issue))
+            removed = self.cursor.fetchall()
+            record_alert_events(self.cursor, 'delete', removed)
             self.conn.commit()
             
-            if self.cursor.rowcount > 0:
+            if removed:
+                counters.bump(self.counter)
                 return "GW Alert Removed"
             else:
                 return "GW Alert Not Found"
@@ -750,14 +1339,137 @@ class gw_alert_database:
             logger.error(f"Error removing from DB: {e}")
             return "Error occurred"
 
-        # Destroyer method to close the connection
+        # Release the cursor, the connection stays open in the pool
+    def close(self):
+        if self.conn:
+            self.cursor.close()
+            if self.conn.in_transaction:
+                self.conn.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class inventory_database:
+    db_file = "storage/inventory.db"
+    def __init__(self):
+        self.conn = pool.connect(self.db_file)
+        self.cursor = self.conn.cursor()
+        pool.initialize(self.db_file, self.initialize_inventory_db)
+
+    def initialize_inventory_db(self):
+        # Single-row table holding the latest ChirpStack inventory snapshot
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+        self.conn.commit()
+
+    def fetch_snapshot_version(self):
+        self.cursor.execute("""
+        SELECT version FROM snapshot WHERE id = 1
+        """)
+        result = self.cursor.fetchone()
+        return result[0] if result else 0
+
+    def fetch_snapshot(self):
+        self.cursor.execute("""
+        SELECT version, data, updated_at FROM snapshot WHERE id = 1
+        """)
+        return self.cursor.fetchone()
+
+    # Store a snapshot, the version only moves when its checksum changed
+    def snapshot_write(self, data, checksum, updated_at):
+        try:
+            self.cursor.execute("""
+            INSERT INTO snapshot (id, version, checksum, data, updated_at)
+            VALUES (1, 1, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                version = CASE WHEN checksum = excluded.checksum THEN version ELSE version + 1 END,
+                checksum = excluded.checksum,
+                data = excluded.data,
+                updated_at = excluded.updated_at
+            RETURNING version
+            """, (checksum, data, updated_at))
+            version = self.cursor.fetchall()[0][0]
+            self.conn.commit()
+            return version
+        except sqlite3.Error as e:
+            logger.error(f"Error saving to DB: {e}")
+
+    # Release the cursor, the connection stays open in the pool
+    def close(self):
+        if self.conn:
+            self.cursor.close()
+            if self.conn.in_transaction:
+                self.conn.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class geocode_database:
+    db_file = "storage/geocode.db"
+    def __init__(self):
+        self.conn = pool.connect(self.db_file)
+        self.cursor = self.conn.cursor()
+        pool.initialize(self.db_file, self.initialize_geocode_db)
+
+    def initialize_geocode_db(self):
+        # Resolved addresses keyed by coordinates quantized to a fixed grid
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS geocode (
+            lat_key INTEGER NOT NULL,
+            long_key INTEGER NOT NULL,
+            address TEXT NOT NULL,
+            source TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (lat_key, long_key)
+        ) WITHOUT ROWID
+        """)
+        self.conn.commit()
+
+    def fetch_address(self, lat_key, long_key):
+        self.cursor.execute("""
+        SELECT address FROM geocode
+        WHERE lat_key = ? AND long_key = ?
+        """, (lat_key, long_key))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def address_write(self, lat_key, long_key, address, source):
+        try:
+            self.cursor.execute("""
+            INSERT INTO geocode (lat_key, long_key, address, source, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (lat_key, long_key) DO UPDATE SET
+                address = excluded.address,
+                source = excluded.source,
+                created_at = excluded.created_at
+            """, (lat_key, long_key, address, source, time.time()))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error saving to DB: {e}")
+
+    # Release the cursor, the connection stays open in the pool
     def close(self):
         if self.conn:
             self.cursor.close()
-            self.conn.close()
+            if self.conn.in_transaction:
+                self.conn.rollback()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
\ No newline at end of file
+        self.close()
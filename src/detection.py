@@ -0,0 +1,116 @@
+import os
+import json
+import numpy as np
+from log import logger
+
+# Path to the JSON file holding detection rules and per-profile thresholds
+RULES_FILE = os.getenv('DETECTION_RULES_FILE', 'detection_rules.json')
+
+OPERATORS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal
+}
+
+
+class detection_engine:
+    """
+    Evaluates declarative detection rules over whole-fleet metric arrays.
+
+    A rule compares a metric array against a threshold with one of OPERATORS.
+    The threshold is a number, the name of another metric (e.g. expected_rate)
+    or the name of a per-profile threshold, optionally multiplied by a
+    per-profile factor. Rules listing other issues under 'unless' are not
+    evaluated for entities where one of those issues was raised.
+    A rule may set clear_threshold and/or clear_factor for hysteresis: an
+    alert that is already active stays raised while the metric still breaches
+    the clear threshold, even if it no longer breaches the raise threshold.
+    """
+    def __init__(self, rules_file=RULES_FILE):
+        self.rules_file = rules_file
+        self.mtime = None
+        self.config = {}
+
+    def load(self):
+        # Re-read the rules file whenever it changes on disk
+        try:
+            mtime = os.path.getmtime(self.rules_file)
+            if mtime != self.mtime:
+                with open(self.rules_file, 'r') as file:
+                    self.config = json.load(file)
+                self.mtime = mtime
+        except FileNotFoundError:
+            logger.error(f"Detection rules file '{self.rules_file}' not found.")
+        except json.JSONDecodeError as e:
+            logger.error(f"Error parsing detection rules: {e}")
+        return self.config
+
+    def rules(self, name):
+        return self.load().get(name, [])
+
+    def thresholds(self, euis, kind='devices'):
+        """
+        Build one array per threshold name, holding each entity's value
+        from its profile (falling back to the 'default' profile).
+        """
+        config = self.load()
+        profiles = config.get('profiles', {})
+        default = profiles.get('default', {})
+        assignment = config.get(kind, {})
+        names = set(default)
+        for profile in profiles.values():
+            names.update(profile)
+        thresholds = {}
+        for name in names:
+            values = np.full(len(euis), default.get(name, np.nan), dtype=float)
+            for profile_name, profile in profiles.items():
+                if profile_name == 'default' or name not in profile:
+                    continue
+                mask = np.fromiter((assignment.get(eui) == profile_name for eui in euis), dtype=bool, count=len(euis))
+                values[mask] = profile[name]
+            thresholds[name] = values
+        return thresholds
+
+    def evaluate(self, rules, euis, metrics, kind='devices', active=None):
+        """
+        Evaluate rules against metric arrays aligned with euis.
+        active optionally maps an issue to a boolean array marking the
+        entities where that alert is currently raised, enabling hysteresis.
+        Returns a list of (rule, raised, evaluated) where raised marks the
+        entities breaching the rule and evaluated marks the entities the rule
+        applied to (not masked by an 'unless' issue).
+        """
+        thresholds = self.thresholds(euis, kind)
+        active = active or {}
+        raised_by_issue = {}
+        results = []
+        for rule in rules:
+            values = metrics[rule['metric']]
+            compare = OPERATORS[rule['op']]
+            raised = compare(values, resolve_threshold(rule['threshold'], rule.get('factor'), metrics, thresholds))
+            if rule['issue'] in active and ('clear_threshold' in rule or 'clear_factor' in rule):
+                clear_threshold = resolve_threshold(rule.get('clear_threshold', rule['threshold']), rule.get('clear_factor', rule.get('factor')), metrics, thresholds)
+                raised |= active[rule['issue']] & compare(values, clear_threshold)
+            evaluated = np.ones(len(euis), dtype=bool)
+            for issue in rule.get('unless', []):
+                if issue in raised_by_issue:
+                    evaluated &= ~raised_by_issue[issue]
+            raised &= evaluated
+            raised_by_issue[rule['issue']] = raised
+            results.append((rule, raised, evaluated))
+        return results
+
+
+def resolve_threshold(threshold, factor, metrics, thresholds):
+    # A number, or the name of a metric or per-profile threshold, optionally scaled by a per-profile factor
+    if isinstance(threshold, str):
+        threshold = metrics[threshold] if threshold in metrics else thresholds[threshold]
+    if factor:
+        threshold = threshold * thresholds[factor]
+    return threshold
+
+def format_message(rule, value):
+    return rule['message'].format(value=value)
@@ -1,11 +1,12 @@
 import grpc
-from google.protobuf.json_format import MessageToJson
+from google.protobuf.json_format import MessageToDict
 from chirpstack_api import api
 from google.protobuf.timestamp_pb2 import Timestamp
 from datetime import datetime, timedelta, timezone
-import json
-import os
-from application_api import get_application_list
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from application_api import iter_all_applications
+from chirpstack import get_stub, call, paginate, MAX_CONCURRENCY
+from protobuf_convert import device_item_to_dict, metrics_to_dict
 from log import logger
 
 def convert_to_readable_format(timestamp_str, offset_hours=5, offset_minutes=30):
@@ -19,20 +20,6 @@ def convert_to_readable_format(timestamp_str, offset_hours=5, offset_minutes=30)
     # Convert to a more readable format (e.g., 2024-12-11 16:15:23)
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
-def convert_to_ist(utc_timestamp):
-    """
-    Convert a UTC timestamp (in string format) to Indian Standard Time (IST).
-    Add 5 hours and 30 minutes to the UTC time to get IST.
-    """
-    # Parse the UTC timestamp string to a datetime object
-    utc_datetime = datetime.strptime(utc_timestamp, '%Y-%m-%dT%H:%M:%SZ')
-    
-    # Add 5 hours to get IST
-    ist_datetime = utc_datetime + timedelta(hours=5)
-    
-    # Return the IST datetime as a string in the same format
-    return ist_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
-
 def checkInactive(last_seen_str):
     # Parse the UTC string to a datetime object
     last_seen_time = datetime.fromisoformat(last_seen_str.rstrip('Z')).replace(tzinfo=timezone.utc)
@@ -49,79 +36,76 @@ def checkInactive(last_seen_str):
 
 
 def get_dev_list():
-    # Get environment variables
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-    chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-    
-    auth_token = [("authorization", "Bearer %s" % api_token)]
     """
     Fetches the list of a all devices in all applications under all tenants.
     """
-    device_list=[]
-    with grpc.insecure_channel(chirpstack_server) as channel:
-        application_list=get_application_list()
-        for application in application_list:
-            client = api.DeviceServiceStub(channel)
-            req = api.ListDevicesRequest()
-            req.limit=100
-            req.application_id=application["id"]
-            resp = client.List(req, metadata=auth_token)
-            device_list += json.loads(MessageToJson(resp))['result']
-                
-        return device_list
+    return list(iter_all_devices())
+
+def iter_all_devices(max_workers=None):
+    """
+    Yields every device in every application. Each application is listed on a
+    bounded thread pool as soon as it is discovered, and its devices are
+    yielded as soon as that listing completes.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_CONCURRENCY) as executor:
+        futures = [executor.submit(list_devices, application["id"]) for application in iter_all_applications()]
+        for future in as_completed(futures):
+            yield from future.result()
+
+def list_devices(application_id):
+    return [device_item_to_dict(device) for device in iter_devices(application_id)]
+
+def iter_devices(application_id):
+    client = get_stub(api.DeviceServiceStub)
+    return paginate(client.List, api.ListDevicesRequest, application_id=application_id)
     
 def get_dev_status():
-    # Get environment variables
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-
     """
     Fetches the status of a all devices in all applications under all tenants.
     """
-    device_list = get_dev_list()
     result = {
                 "total": 0,
                 "online": 0,
                 "offline": 0,
                 "never_seen": 0
             }
-    result["total"] = len(device_list)
-    for device in device_list:
-        lastSeenAt = device.get("lastSeenAt", "Unknown")
-        if lastSeenAt == "Unknown":
-            result["never_seen"] += 1
-        elif checkInactive(lastSeenAt):
-            result["offline"] += 1
-        else:
-            result["online"] += 1
+    # Devices are counted as each application's listing arrives
+    for device in iter_all_devices():
+        result["total"] += 1
+        result[device_state(device)] += 1
             
     return result
 
+def device_state(device):
+    lastSeenAt = device.get("lastSeenAt", "Unknown")
+    if lastSeenAt == "Unknown":
+        return "never_seen"
+    elif checkInactive(lastSeenAt):
+        return "offline"
+    else:
+        return "online"
+
             
 def get_dev_details(dev_eui):
-     # Get environment variables
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-    chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-    auth_token = [("authorization", "Bearer %s" % api_token)]
     """
     Fetches the details of a specific device by its ID.
     """
     try:
-        with grpc.insecure_channel(chirpstack_server) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui=dev_eui
-            resp = client.Get(req, metadata=auth_token)
+        client = get_stub(api.DeviceServiceStub)
+        req = api.GetDeviceRequest()
+        req.dev_eui=dev_eui
+        resp = call(client.Get, req)
         if resp:
-            resp_json = json.loads(MessageToJson(resp))
+            device = resp.device
             result = {
-                    "deviceId": resp_json["device"].get("devEui","Unknown"),
-                    "name": resp_json["device"].get("name","Unknown"),
-                    "appId": resp_json["device"].get("applicationId","Unknown"),
-                    "devProfileId": resp_json["device"].get("deviceProfileId","Unknown"),
-                    "createdAt": convert_to_readable_format(resp_json.get("createdAt", "")) if resp_json.get("createdAt") else "Unknown",
-                    "updatedAt": convert_to_readable_format(resp_json.get("updatedAt", "")) if resp_json.get("updatedAt") else "Unknown",
-                    "lastSeenAt": convert_to_readable_format(resp_json.get("lastSeenAt", "")) if resp_json.get("lastSeenAt") else "Unknown",
-                    "status": resp_json.get("deviceStatus", "Unknown")
+                    "deviceId": device.dev_eui or "Unknown",
+                    "name": device.name or "Unknown",
+                    "appId": device.application_id or "Unknown",
+                    "devProfileId": device.device_profile_id or "Unknown",
+                    "createdAt": convert_to_readable_format(resp.created_at.ToJsonString()) if resp.HasField("created_at") else "Unknown",
+                    "updatedAt": convert_to_readable_format(resp.updated_at.ToJsonString()) if resp.HasField("updated_at") else "Unknown",
+                    "lastSeenAt": convert_to_readable_format(resp.last_seen_at.ToJsonString()) if resp.HasField("last_seen_at") else "Unknown",
+                    "status": MessageToDict(resp.device_status) if resp.HasField("device_status") else "Unknown"
             }
             return result
         # If the device_id is not found
@@ -134,10 +118,6 @@ def get_dev_details(dev_eui):
     
 def get_device_metrics(device_id):
 
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-    chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-    auth_token = [("authorization", "Bearer %s" % api_token)]
-
     # Get the current time
     now = datetime.now()
 
@@ -164,21 +144,15 @@ def get_device_metrics(device_id):
     
     # Call gRPC service
     try:
-        with grpc.insecure_channel(chirpstack_server) as channel:
-            client = api.DeviceServiceStub(channel)
-            resp = client.GetLinkMetrics(req, metadata=auth_token)
+        client = get_stub(api.DeviceServiceStub)
+        resp = call(client.GetLinkMetrics, req)
             
         if not resp:
             logger.info("No data returned for the given time range.")
             return None
         logger.info(f"Fetching metrics for device ID: {device_id}")
-        resp_json = json.loads(MessageToJson(resp))
-        for key, value in resp_json.items():
-            if isinstance(value, dict):  # Check for dicts containing timestamps
-                if 'timestamps' in value:
-                    value['timestamps'] = [convert_to_ist(ts) for ts in value['timestamps']]
-        # Convert gRPC response to JSON format
-        return resp_json
+        # Convert the gRPC response to a dict with IST timestamps
+        return metrics_to_dict(resp)
     
     except grpc.RpcError as e:
         # Handle gRPC error (e.g., network issues, invalid response, etc.)
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import queue
+import threading
+from db import alert_database, gw_alert_database, inventory_database
+from inventory import get_status
+from registry import registry
+from log import logger
+
+# Milliseconds a browser waits before reconnecting a dropped stream
+RETRY_MS = 5000
+
+
+def parse_event_id(event_id):
+    # Event ids are '<device event>.<gateway event>.<snapshot version>'
+    try:
+        device, gateway, status = (int(part) for part in event_id.split('.'))
+        return {'device': device, 'gateway': gateway, 'status': status}
+    except (AttributeError, ValueError):
+        return None
+
+def format_event(event_id, name, data):
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class event_broker:
+    """
+    Pushes alert changes and inventory status changes to dashboards as
+    Server-Sent Events. One thread per web process reads the alert event
+    logs and the snapshot version once per interval, only while at least one
+    client is connected, and fans new events out to every subscriber's queue.
+    Clients reconnecting with Last-Event-ID are replayed what they missed.
+    Each open stream holds a server thread, so at most max_streams are served
+    per process; further clients are refused and fall back to polling.
+    """
+    sources = {'device': alert_database, 'gateway': gw_alert_database}
+
+    def __init__(self, interval=1.0, heartbeat=15.0, max_duration=300.0, max_queue=1000, max_streams=16):
+        self.interval = interval
+        self.max_streams = max_streams
+        self.heartbeat = heartbeat
+        self.max_duration = max_duration
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.position = None
+        self.pid = None
+        self.poller = None
+
+    def _ensure_poller(self):
+        # Web servers fork after import, so the poll thread is started lazily in each process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.subscribers = set()
+            self.position = None
+            self.poller = threading.Thread(target=self._poll_loop, name="event-broker", daemon=True)
+            self.poller.start()
+
+    def _event_id(self):
+        return f"{self.position['device']}.{self.position['gateway']}.{self.position['status']}"
+
+    def _current_position(self):
+        position = {}
+        for kind, source in self.sources.items():
+            with source() as db:
+                position[kind] = db.alert_event_bounds()[1]
+        with inventory_database() as db:
+            position['status'] = db.fetch_snapshot_version()
+        return position
+
+    def current_event_id(self):
+        # Id of the current end of the logs, for clients opening a stream after loading the lists
+        position = self._current_position()
+        return f"{position['device']}.{position['gateway']}.{position['status']}"
+
+    def _alert_event(self, kind, op, data):
+        if op == 'reset':
+            return 'reset', {'kind': kind}
+        if kind == 'device':
+            # Same shape as the rows of /device_alerts
+            device = registry.get_device(data['eui'])
+            gateway = registry.get_gateway(device['gw_id']) if device else None
+            alert = [data['name'], gateway['name'] if gateway else "Unknown", data['issue'], data['message'], data['severity'], data['uid']]
+        else:
+            alert = [data['name'], data['issue'], data['message'], data['severity'], data['uid']]
+        return 'alert', {'kind': kind, 'op': op, 'alert': alert}
+
+    def _read(self, kind, after, until=None):
+        # Formatted events of one alert log after the given id, advancing the position as they are read
+        messages = []
+        with self.sources[kind]() as db:
+            while True:
+                rows = db.alert_events(after)
+                for event_id, op, data in rows:
+                    if until is not None and event_id > until:
+                        return messages
+                    after = self.position[kind] = event_id
+                    messages.append(format_event(self._event_id(), *self._alert_event(kind, op, json.loads(data))))
+                if len(rows) < 500:
+                    return messages
+
+    def _deliver(self, subscriber, message):
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            # A client too far behind drops its backlog and reloads everything instead
+            while not subscriber.empty():
+                subscriber.get_nowait()
+            for kind in self.sources:
+                subscriber.put_nowait(format_event(self._event_id(), 'reset', {'kind': kind}))
+
+    def subscribe(self, last_event_id=None):
+        # Returns the subscriber's queue, or None when this process already serves max_streams
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        status_id = None
+        with self.lock:
+            self._ensure_poller()
+            if len(self.subscribers) >= self.max_streams:
+                return None
+            if not self.subscribers or self.position is None:
+                # Nothing was polled while idle, start from the current end of the logs
+                self.position = self._current_position()
+            last = parse_event_id(last_event_id)
+            if last is not None:
+                # Replay what the client missed; ids stay at the client's position for
+                # logs not replayed yet, so a drop mid-replay resumes correctly
+                current = self.position
+                self.position = dict(last)
+                try:
+                    for kind, source in self.sources.items():
+                        with source() as db:
+                            oldest = db.alert_event_bounds()[0]
+                        if last[kind] > current[kind] or (oldest and last[kind] < oldest - 1):
+                            # The log was trimmed past (or reset beyond) what the client has seen
+                            self.position[kind] = current[kind]
+                            self._deliver(subscriber, format_event(self._event_id(), 'reset', {'kind': kind}))
+                            continue
+                        for message in self._read(kind, last[kind], current[kind]):
+                            self._deliver(subscriber, message)
+                        self.position[kind] = current[kind]
+                    if last['status'] != current['status'] and current['status']:
+                        self.position['status'] = current['status']
+                        status_id = self._event_id()
+                finally:
+                    self.position = current
+            self.subscribers.add(subscriber)
+        if status_id is not None:
+            # get_status can list ChirpStack live, so it runs outside the lock
+            self._deliver(subscriber, format_event(status_id, 'status', get_status()))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def poll(self):
+        with self.lock:
+            if not self.subscribers:
+                return
+            for kind in self.sources:
+                for message in self._read(kind, self.position[kind]):
+                    for subscriber in self.subscribers:
+                        self._deliver(subscriber, message)
+            with inventory_database() as db:
+                version = db.fetch_snapshot_version()
+            if version == self.position['status']:
+                return
+        # get_status can list ChirpStack live, so it runs without blocking subscribe/unsubscribe
+        status = get_status()
+        with self.lock:
+            # The position restarts when the last client leaves, a later client started past this version
+            if not self.subscribers or version == self.position['status']:
+                return
+            self.position['status'] = version
+            message = format_event(self._event_id(), 'status', status)
+            for subscriber in self.subscribers:
+                self._deliver(subscriber, message)
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Error polling dashboard events: {e}")
+
+    def stream(self, subscriber):
+        """
+        Generator of the SSE response body for one subscriber. Streams end
+        after max_duration so long-lived connections do not pin a server
+        thread forever; browsers reconnect and resume from their Last-Event-ID.
+        """
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            deadline = time.monotonic() + self.max_duration
+            while time.monotonic() < deadline:
+                try:
+                    yield subscriber.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+
+broker = event_broker(
+    interval=float(os.getenv('EVENTS_POLL_INTERVAL', 1.0)),
+    heartbeat=float(os.getenv('EVENTS_HEARTBEAT', 15)),
+    max_duration=float(os.getenv('EVENTS_MAX_DURATION', 300)),
+    max_streams=int(os.getenv('EVENTS_MAX_STREAMS', 16))
+)
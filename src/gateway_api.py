@@ -1,25 +1,18 @@
-import os
 import grpc
-import json
 from chirpstack_api import api
-from google.protobuf.json_format import MessageToJson
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from google.protobuf.timestamp_pb2 import Timestamp
+import os
+import threading
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from chirpstack import get_stub, call, paginate, MAX_CONCURRENCY
+from protobuf_convert import gateway_item_to_dict, gateway_response_to_dict, metrics_to_dict
 from log import logger
 
-def convert_to_ist(utc_timestamp):
-    """
-    Convert a UTC timestamp (in string format) to Indian Standard Time (IST).
-    Add 5 hours and 30 minutes to the UTC time to get IST.
-    """
-    # Parse the UTC timestamp string to a datetime object
-    utc_datetime = datetime.strptime(utc_timestamp, '%Y-%m-%dT%H:%M:%SZ')
-    
-    # Add 5 hours to get IST
-    ist_datetime = utc_datetime + timedelta(hours=5)
-    
-    # Return the IST datetime as a string in the same format
-    return ist_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
+# Gateway details keyed by gateway ID, filled by detail lookups and by gateway listings
+gateway_cache = TTLCache(maxsize=int(os.getenv('GATEWAY_CACHE_SIZE', 10000)), ttl=float(os.getenv('GATEWAY_CACHE_TTL', 60)))
+gateway_cache_lock = threading.Lock()
 
 def convert_to_readable_format(timestamp_str, offset_hours=5, offset_minutes=30):
     # Parse the ISO 8601 timestamp (e.g., 2024-12-11T10:34:23.225809Z)
@@ -32,96 +25,124 @@ def convert_to_readable_format(timestamp_str, offset_hours=5, offset_minutes=30)
     # Convert to a more readable format (e.g., 2024-12-11 16:15:23)
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
+def iter_gateways():
+    client = get_stub(api.GatewayServiceStub)
+    return paginate(client.List, api.ListGatewaysRequest)
+
 def get_gateways_status():
-    # Get environment variables
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-    chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-    auth_token = [("authorization", "Bearer %s" % api_token)]
     """
     Fetches the status of all gateways.
     """
     try:
-        with grpc.insecure_channel(chirpstack_server) as channel:
-            client = api.GatewayServiceStub(channel)
-            req = api.ListGatewaysRequest()
-            req.limit = 100  # Limit the number of gateways fetched
-            
-            # Send request to ChirpStack server
-            resp = client.List(req, metadata=auth_token)
-            result = {
-                "total": resp.total_count,
-                "online": 0,
-                "offline": 0,
-                "never_seen": 0
-            }
-
-            for gateway in resp.result:
-                try:
-                    g = json.loads(MessageToJson(gateway))
-                    if g["state"] == "ONLINE":
-                        result["online"] += 1
-                    else:
-                        result["offline"] += 1
-                except:
-                        result["never_seen"] +=1
-            return result
+        result = {
+            "total": 0,
+            "online": 0,
+            "offline": 0,
+            "never_seen": 0
+        }
+
+        for gateway in iter_gateways():
+            g = gateway_item_to_dict(gateway)
+            # The listing already carries everything the details page needs
+            cache_gateway(g)
+            result["total"] += 1
+            result[gateway_state(g)] += 1
+        return result
     except grpc.RpcError as e:
         return f"gRPC error: {e.code()} - {e.details()}"
     except Exception as ex:
         return f"An unexpected error occurred: {str(ex)}"
 
 
+def gateway_state(gateway):
+    # NEVER_SEEN is the default enum value, so it is left out of the JSON entirely
+    state = gateway.get("state")
+    if state is None:
+        return "never_seen"
+    elif state == "ONLINE":
+        return "online"
+    else:
+        return "offline"
+
+
+def format_gateway_details(result):
+    # Shape a gateway (as JSON from a list item or a Get response) for the details page
+    return {
+        "tenantId": result.get("tenantId", "Unknown"),
+        "gatewayId": result.get("gatewayId", "Unknown"),
+        "name": result.get("name", "Unknown"),
+        "location": result.get("location", "Unknown"),
+        "properties": result.get("properties", {"region_common_name": "Unknown"}),
+        "createdAt": convert_to_readable_format(result.get("createdAt", "")) if result.get("createdAt") else "Unknown",
+        "updatedAt": convert_to_readable_format(result.get("updatedAt", "")) if result.get("updatedAt") else "Unknown",
+        "lastSeenAt": convert_to_readable_format(result.get("lastSeenAt", "")) if result.get("lastSeenAt") else "Unknown",
+        "state": result.get("state", "Unknown")
+    }
+
+def cache_gateway(result):
+    with gateway_cache_lock:
+        gateway_cache[result.get("gatewayId")] = format_gateway_details(result)
+
+def fetch_gateway(gateway_id):
+    """
+    Fetch one gateway with GatewayService.Get and flatten the response into
+    the same JSON shape as a gateway list item.
+    """
+    client = get_stub(api.GatewayServiceStub)
+    req = api.GetGatewayRequest(gateway_id=gateway_id)
+    resp = call(client.Get, req)
+    result = gateway_response_to_dict(resp)
+    # Get has no state field, derive it the way ChirpStack does for listings
+    if resp.HasField("last_seen_at"):
+        offline_after = timedelta(seconds=2 * (resp.gateway.stats_interval or 30))
+        last_seen = resp.last_seen_at.ToDatetime(tzinfo=timezone.utc)
+        result["state"] = "ONLINE" if datetime.now(timezone.utc) - last_seen <= offline_after else "OFFLINE"
+    return result
 
 def get_gateway_details(gateway_id):
-
-    # Get environment variables
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-    chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-    auth_token = [("authorization", "Bearer %s" % api_token)]
     """
     Fetches the details of a specific gateway by its ID.
     """
+    with gateway_cache_lock:
+        details = gateway_cache.get(gateway_id)
+    if details is not None:
+        return details
     try:
-        with grpc.insecure_channel(chirpstack_server) as channel:
-            client = api.GatewayServiceStub(channel)
-            req = api.ListGatewaysRequest()
-            req.limit = 100  # Limit the number of gateways fetched
-            
-            # Send request to ChirpStack server
-            resp = client.List(req, metadata=auth_token)
-
-
-            # Check if the result list contains the specified gateway_id
-            for gateway in resp.result:
-                if gateway.gateway_id == gateway_id:
-                    result = json.loads(MessageToJson(gateway))
-                    resp_json = {
-                        "tenantId": result.get("tenantId", "Unknown"),
-                        "gatewayId": result.get("gatewayId", "Unknown"),
-                        "name": result.get("name", "Unknown"),
-                        "location": result.get("location", "Unknown"),
-                        "properties": result.get("properties", {"region_common_name": "Unknown"}),
-                        "createdAt": convert_to_readable_format(result.get("createdAt", "")) if result.get("createdAt") else "Unknown",
-                        "updatedAt": convert_to_readable_format(result.get("updatedAt", "")) if result.get("updatedAt") else "Unknown",
-                        "lastSeenAt": convert_to_readable_format(result.get("lastSeenAt", "")) if result.get("lastSeenAt") else "Unknown",
-                        "state": result.get("state", "Unknown")
-                    }
-                    return resp_json
-    
-            # If the gateway_id is not found
-            return f"Gateway ID {gateway_id} not found in the list."
+        result = fetch_gateway(gateway_id)
+        cache_gateway(result)
+        return format_gateway_details(result)
 
     except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.NOT_FOUND:
+            # If the gateway_id is not found
+            return f"Gateway ID {gateway_id} not found in the list."
         return f"gRPC error: {e.code()} - {e.details()}"
     except Exception as ex:
         return f"An unexpected error occurred: {str(ex)}"
 
+def get_gateways_details(gateway_ids, max_workers=None):
+    """
+    Fetches the details of many gateways at once. Cached gateways are served
+    from memory and the rest are fetched concurrently.
+    Returns a dict of gateway ID -> details (or an error string).
+    """
+    gateway_ids = list(dict.fromkeys(gateway_ids))
+    details = {}
+    with gateway_cache_lock:
+        # One read per entry, an entry can expire between a membership test and the lookup
+        for gateway_id in gateway_ids:
+            cached = gateway_cache.get(gateway_id)
+            if cached is not None:
+                details[gateway_id] = cached
+    missing = [gateway_id for gateway_id in gateway_ids if gateway_id not in details]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(max_workers or MAX_CONCURRENCY, len(missing))) as executor:
+            for gateway_id, result in zip(missing, executor.map(get_gateway_details, missing)):
+                details[gateway_id] = result
+    return details
 
-def get_gateway_metrics(gateway_id):
 
-    api_token = os.getenv('CHIRPSTACK_APIKEY')
-    chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-    auth_token = [("authorization", "Bearer %s" % api_token)]
+def get_gateway_metrics(gateway_id):
 
     # Get the current time
     now = datetime.now()
@@ -148,21 +169,15 @@ def get_gateway_metrics(gateway_id):
     
     # Call gRPC service
     try:
-        with grpc.insecure_channel(chirpstack_server) as channel:
-            client = api.GatewayServiceStub(channel)
-            resp = client.GetMetrics(req, metadata=auth_token)
+        client = get_stub(api.GatewayServiceStub)
+        resp = call(client.GetMetrics, req)
             
         if not resp:
             logger.info("No data returned for the given time range.")
             return None
         logger.info(f"Fetching metrics for gateway ID: {gateway_id}")
-        resp_json = json.loads(MessageToJson(resp))
-        for key, value in resp_json.items():
-            if isinstance(value, dict):  # Check for dicts containing timestamps
-                if 'timestamps' in value:
-                    value['timestamps'] = [convert_to_ist(ts) for ts in value['timestamps']]
-        # Convert gRPC response to JSON format
-        return resp_json
+        # Convert the gRPC response to a dict with IST timestamps
+        return metrics_to_dict(resp)
     
     except grpc.RpcError as e:
         # Handle gRPC error (e.g., network issues, invalid response, etc.)
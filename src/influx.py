@@ -1,5 +1,9 @@
 from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
 import os
+import time
+import atexit
+import threading
 from log import logger
 
 def get_influxdb_client():
@@ -17,3 +21,137 @@ def get_influxdb_client():
     except Exception as e:
         logger.error(f"Error connecting to InfluxDB: {e}")
         raise
+
+def query_packet_rates(query_api, org, bucket, measurement, tag, start="-15m"):
+    """
+    Fetch the packet count of every entity in one query, grouped by the given tag
+    (device_id or gateway_id). Returns a dict of tag value -> packet count.
+    """
+    query = f'''
+    from(bucket: "{bucket}")
+    |> range(start: {start})
+    |> filter(fn: (r) => r._measurement == "{measurement}")
+    |> filter(fn: (r) => r._field == "packet_rate")
+    |> group(columns: ["{tag}"])
+    |> sum()
+    |> group()
+    |> keep(columns: ["{tag}", "_value"])
+    '''
+    packet_rate = {}
+    result = query_api.query(org=org, query=query)
+    if result is not None:
+        for table in result:
+            for record in table.records:
+                entity = record.values.get(tag)
+                packet_rate[entity] = packet_rate.get(entity, 0) + (record.get_value() or 0)
+    return {entity: int(count) for entity, count in packet_rate.items()}
+
+def query_signal_quality(query_api, org, bucket, measurement, tag, start="-1h"):
+    """
+    Fetch mean RSSI and SNR of every entity in one query. The averaging happens
+    in InfluxDB and the result is pivoted into one row per entity.
+    Returns a dict of tag value -> {'avg_rssi': float, 'avg_snr': float}.
+    """
+    query = f'''
+    from(bucket: "{bucket}")
+    |> range(start: {start})
+    |> filter(fn: (r) => r._measurement == "{measurement}")
+    |> filter(fn: (r) => r._field == "avg_rssi" or r._field == "avg_snr")
+    |> group(columns: ["{tag}", "_field"])
+    |> mean()
+    |> group()
+    |> pivot(rowKey: ["{tag}"], columnKey: ["_field"], valueColumn: "_value")
+    '''
+    signal_values = {}
+    result = query_api.query(org=org, query=query)
+    if result is not None:
+        for table in result:
+            for record in table.records:
+                signal_values[record.values.get(tag)] = {
+                    'avg_rssi': record.values.get('avg_rssi'),
+                    'avg_snr': record.values.get('avg_snr')
+                }
+    return signal_values
+
+class influx_batch_writer:
+    """
+    Buffers points as line protocol and writes them to InfluxDB in batches.
+    A batch is flushed once it reaches batch_size points or once the oldest
+    buffered point is flush_interval seconds old, whichever comes first.
+    """
+    def __init__(self, write_api, bucket, org, batch_size=500, flush_interval=1.0):
+        self.write_api = write_api
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.first_write = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name="influx-batch-writer", daemon=True)
+        self.flusher.start()
+
+    def write(self, record):
+        # Accepts an influxdb_client Point or a line protocol string
+        line = record if isinstance(record, str) else record.to_line_protocol()
+        with self.lock:
+            if not self.buffer:
+                self.first_write = time.monotonic()
+            self.buffer.append(line)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = self.buffer
+            self.buffer = []
+            self.first_write = None
+        if not batch:
+            return 0
+        try:
+            self.write_api.write(bucket=self.bucket, org=self.org, record="\n".join(batch))
+            return len(batch)
+        except Exception as e:
+            logger.error(f"Error writing batch of {len(batch)} points to InfluxDB: {e}")
+            return 0
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval / 2):
+            with self.lock:
+                due = self.first_write is not None and time.monotonic() - self.first_write >= self.flush_interval
+            if due:
+                self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+
+
+_batch_writer = None
+_batch_writer_pid = None
+_batch_writer_lock = threading.Lock()
+
+def get_batch_writer():
+    # One writer per process, so every Celery worker child gets its own buffer and flush thread
+    global _batch_writer, _batch_writer_pid
+    with _batch_writer_lock:
+        if _batch_writer is None or _batch_writer_pid != os.getpid():
+            client, bucket, org = get_influxdb_client()
+            write_api = client.write_api(write_options=SYNCHRONOUS)
+            _batch_writer = influx_batch_writer(
+                write_api, bucket, org,
+                batch_size=int(os.getenv('INFLUX_BATCH_SIZE', 500)),
+                flush_interval=float(os.getenv('INFLUX_FLUSH_INTERVAL', 1.0))
+            )
+            _batch_writer_pid = os.getpid()
+            atexit.register(_batch_writer.close)
+        return _batch_writer
+
+def close_batch_writer():
+    global _batch_writer
+    with _batch_writer_lock:
+        if _batch_writer is not None and _batch_writer_pid == os.getpid():
+            _batch_writer.close()
+            _batch_writer = None
@@ -0,0 +1,56 @@
+import os
+import time
+import threading
+from log import logger
+
+
+class uplink_batcher:
+    """
+    Collects uplinks received by the web process and hands them to a Celery
+    task in batches, so a burst of webhooks costs one broker message instead
+    of one message per packet.
+    """
+    def __init__(self, dispatch, max_size=200, max_delay=0.05):
+        self.dispatch = dispatch
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.pid = None
+        self.flusher = None
+
+    def _ensure_flusher(self):
+        # Web servers fork after import, so the flush thread is started lazily in each process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.buffer = []
+            self.flusher = threading.Thread(target=self._flush_loop, name="uplink-batcher", daemon=True)
+            self.flusher.start()
+
+    def add(self, metrics_data, coordinates, device_addr):
+        with self.lock:
+            self._ensure_flusher()
+            self.buffer.append([metrics_data, coordinates, device_addr])
+            full = len(self.buffer) >= self.max_size
+        if full:
+            self.flush()
+        else:
+            self.pending.set()
+
+    def flush(self):
+        with self.lock:
+            batch = self.buffer
+            self.buffer = []
+        if batch:
+            try:
+                self.dispatch(batch)
+            except Exception as e:
+                logger.error(f"Error dispatching batch of {len(batch)} uplinks: {e}")
+
+    def _flush_loop(self):
+        while True:
+            self.pending.wait()
+            time.sleep(self.max_delay)
+            self.pending.clear()
+            self.flush()
@@ -0,0 +1,105 @@
+import json
+import time
+import hashlib
+import threading
+from db import inventory_database
+from application_api import get_tenant_count, get_app_count
+from device_api import iter_all_devices, device_state, get_dev_status
+from gateway_api import iter_gateways, gateway_state, get_gateways_status
+from protobuf_convert import gateway_item_to_dict
+from log import logger
+
+
+def build_snapshot():
+    """
+    List the whole ChirpStack inventory once and summarise it: status counts
+    for devices and gateways plus the last-seen time and state of each entity.
+    """
+    empty = {"total": 0, "online": 0, "offline": 0, "never_seen": 0}
+    snapshot = {
+        "devices": dict(empty),
+        "gateways": dict(empty),
+        "entities": {"devices": {}, "gateways": {}}
+    }
+    for device in iter_all_devices():
+        state = device_state(device)
+        snapshot["devices"]["total"] += 1
+        snapshot["devices"][state] += 1
+        snapshot["entities"]["devices"][device.get("devEui", "Unknown")] = {
+            "name": device.get("name", "Unknown"),
+            "lastSeenAt": device.get("lastSeenAt", "Unknown"),
+            "state": state
+        }
+    for gateway in iter_gateways():
+        g = gateway_item_to_dict(gateway)
+        state = gateway_state(g)
+        snapshot["gateways"]["total"] += 1
+        snapshot["gateways"][state] += 1
+        snapshot["entities"]["gateways"][g.get("gatewayId", "Unknown")] = {
+            "name": g.get("name", "Unknown"),
+            "lastSeenAt": g.get("lastSeenAt", "Unknown"),
+            "state": state
+        }
+    # Counts are set as a side effect of listing the applications above
+    snapshot["tenant_count"] = get_tenant_count()
+    snapshot["app_count"] = get_app_count()
+    return snapshot
+
+# Parts of the snapshot served by /status_data and the dashboard, the only ones the version tracks
+SUMMARY_KEYS = ("devices", "gateways", "tenant_count", "app_count")
+
+def refresh_snapshot():
+    snapshot = build_snapshot()
+    payload = json.dumps(snapshot, sort_keys=True)
+    # lastSeenAt moves on every refresh, checksumming the entities would bump the version each run,
+    # making every web process re-parse the snapshot and push an unchanged status to every dashboard
+    summary = json.dumps({key: snapshot[key] for key in SUMMARY_KEYS}, sort_keys=True)
+    checksum = hashlib.sha1(summary.encode('utf-8')).hexdigest()
+    with inventory_database() as db:
+        version = db.snapshot_write(payload, checksum, time.time())
+    logger.info(f"Inventory snapshot refreshed -- version {version}")
+    return version
+
+
+class snapshot_reader:
+    """
+    Serves the stored snapshot to the web process. Only the version number is
+    read per call, the snapshot itself is parsed again only when its summary
+    counts change, so the per-entity map may lag behind the stored one.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.snapshot = None
+
+    def get(self):
+        with inventory_database() as db:
+            version = db.fetch_snapshot_version()
+            if version == 0:
+                return None
+            with self.lock:
+                if version != self.version:
+                    row = db.fetch_snapshot()
+                    self.version, self.snapshot = row[0], json.loads(row[1])
+                    self.snapshot["version"] = row[0]
+                    self.snapshot["updated_at"] = row[2]
+                return self.snapshot
+
+reader = snapshot_reader()
+
+def get_snapshot():
+    return reader.get()
+
+def get_status():
+    snapshot = get_snapshot()
+    if snapshot is None:
+        # No snapshot yet (beat has not run), fall back to a live listing
+        return {
+            'gateways': get_gateways_status(),
+            'devices': get_dev_status()
+        }
+    return {
+        'gateways': snapshot['gateways'],
+        'devices': snapshot['devices'],
+        'version': snapshot['version']
+    }
@@ -1,42 +1,281 @@
-from geopy.geocoders import Nominatim
+import os
+import math
+import time
+import threading
+import numpy as np
 import requests
-from db import gateway_database
-
-def rev_geocode(lat, long, gateway_id):
-        # Initialize geolocator
-        geolocator = Nominatim(user_agent="geoapi")
-
-        # Reverse geocoding
-        try:
-            location = geolocator.reverse((lat, long))
-            address = location.raw.get('address', {})
-            road = address.get('road', '')
-            place = address.get('suburb', '') or address.get('town', '') or address.get('village', '') or address.get('county', '')
-            with gateway_database() as db:
-                db.save_to_db("Unknown", gateway_id, f"{road}, {place}", "Unknown")  if place and road else "Location information not available"
-            return f"{road}, {place}" if place and road else "Location information not available"
-        except:
-            # Define the API endpoint and parameters
-            url = "https://nominatim.openstreetmap.org/reverse"
-            params = {
-                "lat": lat,
-                "lon": long,
-                "format": "json"
-            }
-            
-            # Make the GET request
-            response = requests.get(url, params=params, headers={"User-Agent": "MyApp"})
-            response.raise_for_status()  # Raise an exception for HTTP errors
-            
-            # Parse the JSON response
-            location_data = response.json()
-            
-            # Extract place name and postal code
-            place_name = location_data.get("address", {}).get("village") or \
-                        location_data.get("address", {}).get("town") or \
-                        location_data.get("address", {}).get("city")
-            db.save_to_db(lat, long, f"{place_name}")  if place_name else "Location information not available"
-            return f"{place_name}" if place_name else "Location information not available"
-
-
-    
+from cachetools import LRUCache, TTLCache
+from db import geocode_database
+from log import logger
+
+# GeoNames dump (e.g. cities1000.txt from download.geonames.org/export/dump) used for offline lookups
+GAZETTEER_FILE = os.getenv('GAZETTEER_FILE', 'storage/cities1000.txt')
+# Decimal places coordinates are rounded to before caching, 3 is roughly 100 m
+GEOCODE_PRECISION = int(os.getenv('GEOCODE_PRECISION', 3))
+# Farthest (km) a gazetteer place may be from a gateway to name its location
+GEOCODE_MAX_DISTANCE = float(os.getenv('GEOCODE_MAX_DISTANCE', 25))
+# Nominatim fallback: 'auto' only while no gazetteer is loaded, 'true' for anything the gazetteer cannot name, 'false' never
+GEOCODE_REMOTE = os.getenv('GEOCODE_REMOTE', 'auto').lower()
+GEOCODE_REMOTE_URL = os.getenv('GEOCODE_REMOTE_URL', 'https://nominatim.openstreetmap.org/reverse')
+GEOCODE_REMOTE_INTERVAL = float(os.getenv('GEOCODE_REMOTE_INTERVAL', 1.0))
+GEOCODE_USER_AGENT = os.getenv('GEOCODE_USER_AGENT', 'Argus')
+# Seconds a process waits before retrying coordinates that could not be resolved
+GEOCODE_RETRY_INTERVAL = float(os.getenv('GEOCODE_RETRY_INTERVAL', 3600))
+
+EARTH_RADIUS = 6371.0088
+# Size (degrees) of the grid cells places are bucketed into
+CELL_SIZE = 1.0
+
+
+def quantize(lat, long, precision=GEOCODE_PRECISION):
+    scale = 10 ** precision
+    return round(lat * scale), round(long * scale)
+
+def distance_km(lat1, long1, lat2, long2):
+    # Great-circle (haversine) distance between two points
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+def parse_coordinates(coordinates):
+    # Stored gateway coordinates are 'lat,long,alt', anything else counts as unknown
+    try:
+        lat, long, alt = (float(value) for value in str(coordinates).split(','))
+        return lat, long, alt
+    except ValueError:
+        return None
+
+
+class gazetteer_index:
+    """
+    Places of a GeoNames gazetteer bucketed into a grid of CELL_SIZE degree
+    cells. A nearest-place query only measures the places in the cells that
+    can lie within max_distance of the point, using vectorized haversine
+    distances over each cell's coordinate arrays.
+    """
+    def __init__(self, cell=CELL_SIZE):
+        self.cell = cell
+        self.cells = {}
+        self.count = 0
+
+    def _cell(self, lat, long):
+        return math.floor(lat / self.cell), math.floor(long / self.cell)
+
+    def load(self, path):
+        buckets = {}
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                # GeoNames columns: 1 name, 4 latitude, 5 longitude, 8 country code
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    lat, long = float(fields[4]), float(fields[5])
+                except (IndexError, ValueError):
+                    continue
+                label = f"{fields[1]}, {fields[8]}" if len(fields) > 8 and fields[8] else fields[1]
+                bucket = buckets.setdefault(self._cell(lat, long), ([], [], []))
+                bucket[0].append(lat)
+                bucket[1].append(long)
+                bucket[2].append(label)
+        for key, (lats, longs, labels) in buckets.items():
+            self.cells[key] = (np.radians(lats), np.radians(longs), labels)
+            self.count += len(labels)
+        return self
+
+    def nearest(self, lat, long, max_distance):
+        # Returns the label of the closest place within max_distance km, or None
+        row, col = self._cell(lat, long)
+        lat_span = math.ceil(max_distance / (math.radians(self.cell) * EARTH_RADIUS))
+        # A degree of longitude shrinks towards the poles, so more columns are searched there
+        edge = min(abs(lat) + lat_span * self.cell, 89.9)
+        columns = int(360 / self.cell)
+        long_span = min(math.ceil(lat_span / math.cos(math.radians(edge))), columns // 2)
+        phi, lam = math.radians(lat), math.radians(long)
+        best, best_distance = None, max_distance
+        for i in range(row - lat_span, row + lat_span + 1):
+            for j in range(col - long_span, col + long_span + 1):
+                # Wrap across the antimeridian
+                j = (j + columns // 2) % columns - columns // 2
+                bucket = self.cells.get((i, j))
+                if bucket is None:
+                    continue
+                lats, longs, labels = bucket
+                a = np.sin((lats - phi) / 2) ** 2 + math.cos(phi) * np.cos(lats) * np.sin((longs - lam) / 2) ** 2
+                distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+                index = int(np.argmin(distances))
+                if distances[index] <= best_distance:
+                    best, best_distance = labels[index], float(distances[index])
+        return best
+
+
+class reverse_geocoder:
+    """
+    Resolves gateway coordinates to a place name without the network. Results
+    are cached in memory and in storage/geocode.db keyed by coordinates
+    quantized to precision decimals, so every gateway in the same ~100 m cell
+    shares one lookup across processes and restarts. Misses are answered from
+    the gazetteer index; only when it has no place within max_distance is
+    Nominatim asked, at most once per remote_interval seconds. remote is
+    'auto' (only while no gazetteer is loaded), 'true' or 'false'.
+    Unresolved points are not stored, only skipped for retry_interval.
+    """
+    def __init__(self, gazetteer_file=GAZETTEER_FILE, precision=GEOCODE_PRECISION, max_distance=GEOCODE_MAX_DISTANCE,
+                 remote_url=None, remote='auto', remote_interval=1.0, user_agent="Argus", memory_size=4096, timeout=5.0, retry_interval=3600.0):
+        self.gazetteer_file = gazetteer_file
+        self.precision = precision
+        self.max_distance = max_distance
+        self.remote_url = remote_url
+        self.remote = remote
+        self.remote_interval = remote_interval
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.memory = LRUCache(maxsize=memory_size)
+        self.misses = TTLCache(maxsize=memory_size, ttl=retry_interval)
+        self.lock = threading.Lock()
+        self.remote_lock = threading.Lock()
+        self.index = None
+        self.session = None
+        self.last_remote = 0.0
+
+    def _gazetteer(self):
+        # Loaded on first use, so processes that never geocode do not pay for it
+        if self.index is None:
+            with self.lock:
+                if self.index is None:
+                    started = time.monotonic()
+                    try:
+                        index = gazetteer_index().load(self.gazetteer_file)
+                        logger.info(f"Loaded {index.count} gazetteer places in {time.monotonic() - started:.1f}s")
+                    except OSError as e:
+                        logger.warning(f"Gazetteer unavailable, offline geocoding disabled: {e}")
+                        if self.remote == 'auto':
+                            logger.info("Gateway addresses will be resolved through the remote geocoder")
+                        index = gazetteer_index()
+                    self.index = index
+        return self.index
+
+    def _remote(self, lat, long):
+        with self.remote_lock:
+            # Nominatim's usage policy allows one request per second
+            wait = self.last_remote + self.remote_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_remote = time.monotonic()
+            if self.session is None:
+                self.session = requests.Session()
+                self.session.headers["User-Agent"] = self.user_agent
+            try:
+                response = self.session.get(self.remote_url, params={"lat": lat, "lon": long, "format": "json"}, timeout=self.timeout)
+                response.raise_for_status()
+                address = response.json().get("address", {})
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"Remote reverse geocoding failed: {e}")
+                return None
+        road = address.get('road', '')
+        place = address.get('suburb') or address.get('village') or address.get('town') or address.get('city') or address.get('county')
+        if place and road:
+            return f"{road}, {place}"
+        return place
+
+    def _use_remote(self, index):
+        if not self.remote_url or self.remote == 'false':
+            return False
+        return self.remote == 'true' or index.count == 0
+
+    def _resolve(self, lat, long):
+        index = self._gazetteer()
+        place = index.nearest(lat, long, self.max_distance)
+        if place:
+            return place, 'gazetteer'
+        if self._use_remote(index):
+            place = self._remote(lat, long)
+            if place:
+                return place, 'remote'
+        return None, None
+
+    def lookup(self, lat, long):
+        key = quantize(lat, long, self.precision)
+        with self.lock:
+            address = self.memory.get(key)
+            missed = self.misses.get(key)
+        if address is not None or missed:
+            return address
+        with geocode_database() as db:
+            address = db.fetch_address(*key)
+            if address is None:
+                # Resolve the cell itself so every point in it caches the same answer
+                scale = 10 ** self.precision
+                address, source = self._resolve(key[0] / scale, key[1] / scale)
+                if address is None:
+                    # Not stored, a later gazetteer or remote lookup may succeed
+                    with self.lock:
+                        self.misses[key] = True
+                    return None
+                db.address_write(*key, address, source)
+        with self.lock:
+            self.memory[key] = address
+        return address
+
+
+geocoder = reverse_geocoder(
+    remote_url=GEOCODE_REMOTE_URL,
+    remote=GEOCODE_REMOTE,
+    remote_interval=GEOCODE_REMOTE_INTERVAL,
+    user_agent=GEOCODE_USER_AGENT,
+    retry_interval=GEOCODE_RETRY_INTERVAL
+)
+
+def rev_geocode(lat, long):
+    # Place name of the coordinates, or None when they cannot be resolved (yet)
+    try:
+        return geocoder.lookup(float(lat), float(long))
+    except (TypeError, ValueError):
+        return None
+
+
+class location_batcher:
+    """
+    Coalesces the gateway positions reported by uplinks and location events
+    and hands them to the location task off the ingest path. Only the latest
+    position of each gateway is kept, and pending positions are sent at most
+    once per delay seconds, so a gateway heard on every uplink costs one
+    low-priority task per window however busy it is.
+    """
+    def __init__(self, dispatch, delay=30.0):
+        self.dispatch = dispatch
+        self.delay = delay
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.pid = None
+        self.flusher = None
+
+    def _ensure_flusher(self):
+        # Web servers and workers fork after import, so the flush thread is started lazily in each process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.positions = {}
+            self.flusher = threading.Thread(target=self._flush_loop, name="location-batcher", daemon=True)
+            self.flusher.start()
+
+    def report(self, eui, lat, long, alt):
+        with self.lock:
+            self._ensure_flusher()
+            self.positions[eui] = [eui, lat, long, alt]
+        self.pending.set()
+
+    def flush(self):
+        with self.lock:
+            updates = list(self.positions.values())
+            self.positions = {}
+        if updates:
+            try:
+                self.dispatch(updates)
+            except Exception as e:
+                logger.error(f"Error dispatching {len(updates)} gateway location updates: {e}")
+
+    def _flush_loop(self):
+        while True:
+            self.pending.wait()
+            time.sleep(self.delay)
+            self.pending.clear()
+            self.flush()
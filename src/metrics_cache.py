@@ -0,0 +1,99 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import LRUCache
+from chirpstack import MAX_CONCURRENCY
+from device_api import get_device_metrics
+from gateway_api import get_gateway_metrics
+from log import logger
+
+# Seconds after the hour at which recently viewed entities are prefetched,
+# giving ChirpStack time to close the aggregate of the hour that just ended
+PREFETCH_DELAY = 5
+
+
+def hour_bucket(now=None):
+    # The metrics window ends at the last full hour, so it changes once per hour
+    now = now or datetime.now()
+    return now.replace(minute=0, second=0, microsecond=0)
+
+
+class metrics_cache:
+    """
+    LRU cache of the device and gateway charts, keyed by entity and hour.
+    get_device_metrics and get_gateway_metrics always ask for the window
+    ending at the last full hour, so a result stays valid until the hour
+    rolls over. The most recently viewed entities are refetched right after
+    each rollover so the first view of the new hour is served from memory.
+    """
+    def __init__(self, fetchers, maxsize=1024, prefetch=50):
+        self.fetchers = fetchers
+        self.cache = LRUCache(maxsize=maxsize)
+        self.prefetch = prefetch
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.prefetcher = None
+
+    def _ensure_prefetcher(self):
+        # Web servers fork after import, so the prefetch thread is started lazily in each process
+        if self.prefetch and self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.prefetcher = threading.Thread(target=self._prefetch_loop, name="metrics-prefetch", daemon=True)
+            self.prefetcher.start()
+
+    def _remember(self, kind, entity):
+        self.recent[(kind, entity)] = None
+        self.recent.move_to_end((kind, entity))
+        while len(self.recent) > self.prefetch:
+            self.recent.popitem(last=False)
+
+    def _fetch(self, kind, entity, bucket):
+        result = self.fetchers[kind](entity)
+        # Failed lookups return None and are retried on the next view
+        if result is not None:
+            with self.lock:
+                self.cache[(kind, entity, bucket)] = result
+        return result
+
+    def get(self, kind, entity):
+        bucket = hour_bucket()
+        with self.lock:
+            self._ensure_prefetcher()
+            if self.prefetch:
+                self._remember(kind, entity)
+            result = self.cache.get((kind, entity, bucket))
+        if result is not None:
+            return result
+        return self._fetch(kind, entity, bucket)
+
+    def prefetch_recent(self):
+        bucket = hour_bucket()
+        with self.lock:
+            pending = [key for key in self.recent if (*key, bucket) not in self.cache]
+        if not pending:
+            return
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(pending))) as executor:
+            for (kind, entity), result in zip(pending, executor.map(lambda key: self._fetch(*key, bucket), pending)):
+                if result is None:
+                    logger.warning(f"Prefetching {kind} metrics for {entity} failed")
+        logger.info(f"Prefetched metrics for {len(pending)} recently viewed entities")
+
+    def _prefetch_loop(self):
+        while True:
+            next_hour = hour_bucket() + timedelta(hours=1, seconds=PREFETCH_DELAY)
+            time.sleep(max((next_hour - datetime.now()).total_seconds(), 1))
+            try:
+                self.prefetch_recent()
+            except Exception as e:
+                logger.error(f"Error prefetching metrics: {e}")
+
+
+chart_metrics = metrics_cache(
+    {'device': get_device_metrics, 'gateway': get_gateway_metrics},
+    maxsize=int(os.getenv('METRICS_CACHE_SIZE', 1024)),
+    prefetch=int(os.getenv('METRICS_PREFETCH_COUNT', 50))
+)
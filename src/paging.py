@@ -0,0 +1,67 @@
+import os
+import json
+import base64
+import binascii
+
+# Page size bounds of the paginated list endpoints
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 500))
+
+# Any of these in the query string switches an endpoint from the full list to a page envelope
+PAGE_PARAMS = ('limit', 'cursor', 'sort', 'order', 'severity', 'issue', 'gateway', 'name')
+
+
+def wants_page(args):
+    return any(param in args for param in PAGE_PARAMS)
+
+def encode_cursor(key):
+    # Opaque cursor holding the (sort value, id) key of the last row of a page
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def bindable(value, integer=False):
+    # Only scalars SQLite can bind are accepted as cursor keys, ids must be 64-bit integers
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return -2**63 <= value < 2**63
+    return not integer and (value is None or isinstance(value, (str, float)))
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, binascii.Error, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, list) or len(key) != 2 or not bindable(key[0]) or not bindable(key[1], integer=True):
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+def page_args(args, sortable, filters):
+    """
+    Validate the page parameters of a request and turn them into keyword
+    arguments for a db page query. Raises ValueError on bad input.
+    """
+    sort = args.get('sort', 'id')
+    if sort not in sortable:
+        raise ValueError(f"sort must be one of {', '.join(sortable)}")
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    kwargs = {
+        'sort': sort,
+        'descending': order == 'desc',
+        'after': decode_cursor(args['cursor']) if args.get('cursor') else None,
+        'limit': min(max(limit, 1), MAX_PAGE_SIZE)
+    }
+    for name in filters:
+        if args.get(name):
+            kwargs[name] = args.get(name)
+    return kwargs
+
+def page_envelope(rows, last):
+    return {"items": rows, "next_cursor": encode_cursor(last)}
@@ -0,0 +1,115 @@
+import math
+import numpy as np
+from chirpstack_api import api
+from chirpstack_api.common import common_pb2
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.internal import type_checkers
+
+# Offset applied to metric timestamps (the charts have always shown UTC+5h)
+IST_OFFSET = np.timedelta64(5, 'h')
+
+# Readers that turn ChirpStack protobuf responses straight into Python dicts.
+# Keys and formats match what json.loads(MessageToJson(...)) used to produce:
+# camelCase names, RFC 3339 timestamps and no key for an unset field.
+
+def _put(result, key, value):
+    if value:
+        result[key] = value
+
+def _put_timestamp(result, key, message, field):
+    if message.HasField(field):
+        result[key] = getattr(message, field).ToJsonString()
+
+def tenant_item_to_dict(tenant):
+    result = {}
+    _put(result, "id", tenant.id)
+    _put(result, "name", tenant.name)
+    return result
+
+def application_item_to_dict(application):
+    result = {}
+    _put(result, "id", application.id)
+    _put(result, "name", application.name)
+    _put(result, "description", application.description)
+    return result
+
+def device_item_to_dict(device):
+    result = {}
+    _put(result, "devEui", device.dev_eui)
+    _put(result, "name", device.name)
+    _put(result, "description", device.description)
+    _put(result, "deviceProfileId", device.device_profile_id)
+    _put(result, "deviceProfileName", device.device_profile_name)
+    _put_timestamp(result, "createdAt", device, "created_at")
+    _put_timestamp(result, "updatedAt", device, "updated_at")
+    _put_timestamp(result, "lastSeenAt", device, "last_seen_at")
+    return result
+
+def gateway_item_to_dict(gateway):
+    result = {}
+    _put(result, "tenantId", gateway.tenant_id)
+    _put(result, "gatewayId", gateway.gateway_id)
+    _put(result, "name", gateway.name)
+    _put(result, "description", gateway.description)
+    if gateway.HasField("location"):
+        result["location"] = MessageToDict(gateway.location)
+    _put(result, "properties", dict(gateway.properties))
+    _put_timestamp(result, "createdAt", gateway, "created_at")
+    _put_timestamp(result, "updatedAt", gateway, "updated_at")
+    _put_timestamp(result, "lastSeenAt", gateway, "last_seen_at")
+    # NEVER_SEEN is the default value and is left out, as MessageToJson does
+    if gateway.state != api.GatewayState.NEVER_SEEN:
+        result["state"] = api.GatewayState.Name(gateway.state)
+    return result
+
+def gateway_response_to_dict(resp):
+    # Flatten a GetGatewayResponse into the shape of a gateway list item
+    gateway = resp.gateway
+    result = {}
+    _put(result, "tenantId", gateway.tenant_id)
+    _put(result, "gatewayId", gateway.gateway_id)
+    _put(result, "name", gateway.name)
+    _put(result, "description", gateway.description)
+    if gateway.HasField("location"):
+        result["location"] = MessageToDict(gateway.location)
+    _put(result, "properties", dict(gateway.metadata))
+    _put_timestamp(result, "createdAt", resp, "created_at")
+    _put_timestamp(result, "updatedAt", resp, "updated_at")
+    _put_timestamp(result, "lastSeenAt", resp, "last_seen_at")
+    return result
+
+def float_value(value):
+    # float32 values as MessageToJson writes them: shortest repr, non-finite values as strings
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "Infinity" if value > 0 else "-Infinity"
+    return type_checkers.ToShortestFloat(value)
+
+def timestamps_to_ist(timestamps):
+    """
+    Convert a repeated Timestamp field to IST strings in one vectorized step
+    instead of formatting and re-parsing each timestamp.
+    """
+    seconds = np.fromiter((ts.seconds for ts in timestamps), dtype=np.int64, count=len(timestamps))
+    ist = seconds.astype('datetime64[s]') + IST_OFFSET
+    return np.char.add(np.datetime_as_string(ist, unit='s'), 'Z').tolist()
+
+def metric_to_dict(metric):
+    result = {
+        "name": metric.name,
+        "timestamps": timestamps_to_ist(metric.timestamps),
+        "datasets": [{"label": dataset.label, "data": [float_value(value) for value in dataset.data]} for dataset in metric.datasets]
+    }
+    # COUNTER is the default value and is left out, as MessageToJson does
+    if metric.kind != common_pb2.MetricKind.COUNTER:
+        result["kind"] = common_pb2.MetricKind.Name(metric.kind)
+    return result
+
+def metrics_to_dict(resp):
+    # Every set Metric field of a metrics response, keyed by its camelCase name
+    return {
+        field.json_name: metric_to_dict(getattr(resp, field.name))
+        for field in resp.DESCRIPTOR.fields
+        if resp.HasField(field.name)
+    }
@@ -0,0 +1,67 @@
+import os
+import time
+import threading
+from db import gateway_database, device_database, on_write
+
+DEVICE_COLUMNS = ('id', 'name', 'eui', 'gw_id', 'dev_addr', 'uplink_interval', 'uid')
+GATEWAY_COLUMNS = ('id', 'name', 'eui', 'address', 'sim_number', 'coordinates', 'uid')
+
+
+class registry_cache:
+    """
+    Read-through cache of the device and gateway tables for the ingest path.
+    Each table is loaded with a single query and then served from memory.
+    Writes made through db.py in this process patch or invalidate the cache
+    immediately, writes from other processes are picked up after ttl seconds.
+    """
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.tables = {'device': None, 'gateway': None}
+        self.loaded_at = {'device': 0.0, 'gateway': 0.0}
+
+    def _load(self, table):
+        if table == 'device':
+            with device_database() as db:
+                rows = db.device_query() or []
+            columns = DEVICE_COLUMNS
+        else:
+            with gateway_database() as db:
+                rows = db.gateway_query() or []
+            columns = GATEWAY_COLUMNS
+        records = {}
+        for row in rows:
+            # Keep the first row per EUI, matching the fetchone() lookups in db.py
+            records.setdefault(row[2], dict(zip(columns, row)))
+        return records
+
+    def _table(self, table):
+        with self.lock:
+            records = self.tables[table]
+            if records is not None and time.monotonic() - self.loaded_at[table] < self.ttl:
+                return records
+            records = self._load(table)
+            self.tables[table] = records
+            self.loaded_at[table] = time.monotonic()
+            return records
+
+    def get_device(self, eui):
+        return self._table('device').get(eui)
+
+    def get_gateway(self, eui):
+        return self._table('gateway').get(eui)
+
+    def invalidate(self, table, eui=None, **fields):
+        with self.lock:
+            records = self.tables.get(table)
+            if records is None:
+                return
+            if fields and eui in records:
+                records[eui].update(fields)
+            else:
+                # New or unknown rows force a reload on the next lookup
+                self.tables[table] = None
+
+
+registry = registry_cache(ttl=float(os.getenv('REGISTRY_CACHE_TTL', 30)))
+on_write(registry.invalidate)
@@ -130,56 +130,167 @@
       chartInstances.set(canvasId, newChart);
     }
    // Fetch data from the endpoints
-   async function fetchData(url) {
+   async function fetchData(url, onResponse) {
     try {
       const response = await fetch(url);
       if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+      if (onResponse) onResponse(response);
       return await response.json();
     } catch (error) {
       console.error(`Failed to fetch data from ${url}:`, error);
       return [];
     }
   }
+  // Alerts currently shown, keyed by uid so pushed changes can be applied in place
+  const alertLists = {
+    gateway: new Map(),
+    device: new Map()
+  };
+
+  function renderAlerts(kind) {
+    if (kind === 'gateway') {
+      addRowsToContainer(Array.from(alertLists.gateway.values()), '#dynamic-rows1', true);
+    } else {
+      addRowsToContainer(Array.from(alertLists.device.values()), '#dynamic-rows2');
+    }
+  }
+
+  function loadAlerts(kind) {
+    // Fetch and dynamically populate Gateway or Device Alerts, resolving to the event id the list is current to
+    let eventId = null;
+    const url = kind === 'gateway' ? '/gateway_alerts' : '/device_alerts';
+    return fetchData(url, response => { eventId = response.headers.get('X-Event-Id'); }).then(alerts => {
+      // The uid is the last field of both alert shapes
+      alertLists[kind] = new Map((alerts || []).map(alert => [alert[alert.length - 1], alert]));
+      renderAlerts(kind);
+      return eventId;
+    });
+  }
+
+  function earliestEventId(ids) {
+    // Event ids are '<device event>.<gateway event>.<snapshot version>'; starting from the
+    // lowest position of each log replays anything committed while the lists were loading
+    const parsed = ids.filter(Boolean).map(id => id.split('.').map(Number));
+    if (!parsed.length || parsed.some(parts => parts.length !== 3 || parts.some(isNaN))) return null;
+    return [0, 1, 2].map(i => Math.min(...parsed.map(parts => parts[i]))).join('.');
+  }
+
+  function renderStatus(statusData) {
+    // Dynamically create Doughnut Charts
+    if (statusData && statusData.devices && statusData.gateways) {
+      createDoughnutChart('devices_donut', [
+        statusData.devices.offline,
+        statusData.devices.online,
+        statusData.devices.never_seen
+      ]);
+      createDoughnutChart('gateways_donut', [
+        statusData.gateways.offline,
+        statusData.gateways.online,
+        statusData.gateways.never_seen
+      ]);
+      $('.device_count').text(statusData.devices.total)
+      $('.gateway_count').text(statusData.gateways.total)
+      // Update datetime on page load
+      $('#datetime1').text(getCurrentDateTime());
+      $('#datetime2').text(getCurrentDateTime());
+    }
+  }
+
   function updateStatusAndAlerts() {
-    // Fetch and dynamically populate Gateway Alerts
-    fetchData('/gateway_alerts').then(gwAlerts => {
-      if (gwAlerts && gwAlerts.length) {
-        addRowsToContainer(gwAlerts, '#dynamic-rows1', true);
-      }
+    fetchData('/status_data').then(renderStatus);
+    return Promise.all([loadAlerts('gateway'), loadAlerts('device')]).then(earliestEventId);
+  }
+
+  function reloadAndOpenEvents() {
+    // The stream starts where the freshly loaded lists end, so nothing falls between the two
+    updateStatusAndAlerts().then(eventId => {
+      if (source) return;
+      if (eventId) lastEventId = eventId;
+      if (!document.hidden) openEvents();
     });
+  }
+
+  // Push channel: alert and status changes arrive over /events as they happen.
+  // The stream is closed while the tab is hidden and resumed from the last event id.
+  let source = null;
+  let lastEventId = null;
+  let pollTimer = null;
 
-    // Fetch and dynamically populate Device Alerts
-    fetchData('/device_alerts').then(alerts => {
-      if (alerts && alerts.length) {
-        addRowsToContainer(alerts, '#dynamic-rows2');
+  function startPolling() {
+    if (!pollTimer) {
+      // A refused stream (server at its stream limit) is retried on every poll
+      pollTimer = setInterval(reloadAndOpenEvents, 300000);
+    }
+  }
+
+  function stopPolling() {
+    if (pollTimer) {
+      clearInterval(pollTimer);
+      pollTimer = null;
+    }
+  }
+
+  function openEvents() {
+    if (!window.EventSource) {
+      startPolling();
+      return;
+    }
+    if (source) return;
+    const url = lastEventId ? `/events?last_event_id=${encodeURIComponent(lastEventId)}` : '/events';
+    source = new EventSource(url);
+    const track = event => {
+      if (event.lastEventId) lastEventId = event.lastEventId;
+    };
+    source.addEventListener('open', stopPolling);
+    source.addEventListener('alert', event => {
+      track(event);
+      const { kind, op, alert } = JSON.parse(event.data);
+      const uid = alert[alert.length - 1];
+      if (op === 'delete') {
+        alertLists[kind].delete(uid);
+      } else {
+        alertLists[kind].set(uid, alert);
       }
+      renderAlerts(kind);
     });
-
-    // Fetch and dynamically create Doughnut Charts
-    fetchData('/status_data').then(statusData => {
-      if (statusData && statusData.devices && statusData.gateways) {
-        createDoughnutChart('devices_donut', [
-          statusData.devices.offline,
-          statusData.devices.online,
-          statusData.devices.never_seen
-        ]);
-        createDoughnutChart('gateways_donut', [
-          statusData.gateways.offline,
-          statusData.gateways.online,
-          statusData.gateways.never_seen
-        ]);
-        $('.device_count').text(statusData.devices.total)
-        $('.gateway_count').text(statusData.gateways.total)
-        // Update datetime on page load
-        $('#datetime1').text(getCurrentDateTime());
-        $('#datetime2').text(getCurrentDateTime());
+    source.addEventListener('reset', event => {
+      track(event);
+      loadAlerts(JSON.parse(event.data).kind);
+    });
+    source.addEventListener('status', event => {
+      track(event);
+      renderStatus(JSON.parse(event.data));
+    });
+    source.addEventListener('error', () => {
+      // The browser reconnects on its own unless the server refused the stream
+      if (source.readyState === EventSource.CLOSED) {
+        source = null;
+        startPolling();
       }
-      
     });
   }
-  updateStatusAndAlerts();
-  setInterval(updateStatusAndAlerts, 300000)
 
+  function closeEvents() {
+    if (source) {
+      source.close();
+      source = null;
+    }
+  }
+
+  document.addEventListener('visibilitychange', () => {
+    if (document.hidden) {
+      closeEvents();
+    } else if (!source && !pollTimer) {
+      // Without an id yet (hidden since the first load) the lists are reloaded first
+      if (lastEventId) {
+        openEvents();
+      } else {
+        reloadAndOpenEvents();
+      }
+    }
+  });
+
+  reloadAndOpenEvents();
   });
 
 })(jQuery);
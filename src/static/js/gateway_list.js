@@ -1,88 +1,72 @@
-var properties = [
-	'name',
-	'eui',
-	'address',
-	's_number',
-];
-
-$.each( properties, function( i, val ) {
-	
-	var orderClass = '';
-
-	$("#" + val).click(function(e){
-		e.preventDefault();
-		$('.filter__link.filter__link--active').not(this).removeClass('filter__link--active');
-  		$(this).toggleClass('filter__link--active');
-   		$('.filter__link').removeClass('asc desc');
-
-   		if(orderClass == 'desc' || orderClass == '') {
-    			$(this).addClass('asc');
-    			orderClass = 'asc';
-       	} else {
-       		$(this).addClass('desc');
-       		orderClass = 'desc';
-       	}
-
-		var parent = $(this).closest('.header__item');
-    		var index = $(".header__item").index(parent);
-		var $table = $('.table-content');
-		var rows = $table.find('.table-row').get();
-		var isSelected = $(this).hasClass('filter__link--active');
-		var isNumber = $(this).hasClass('filter__link--number');
-			
-		rows.sort(function(a, b){
-
-			var x = $(a).find('.table-data').eq(index).text();
-    			var y = $(b).find('.table-data').eq(index).text();
-				
-			if(isNumber == true) {
-    					
-				if(isSelected) {
-					return x - y;
-				} else {
-					return y - x;
-				}
-
-			} else {
-			
-				if(isSelected) {		
-					if(x < y) return -1;
-					if(x > y) return 1;
-					return 0;
-				} else {
-					if(x > y) return -1;
-					if(x < y) return 1;
-					return 0;
-				}
-			}
-    		});
-
-		$.each(rows, function(index,row) {
-			$table.append(row);
-		});
-
-		return false;
-	});
-
-});
+// Columns the server can sort the list by, keyed by the id of their header link
+var sortColumns = {
+	'name': 'name',
+	'eui': 'eui',
+};
 
 $(document).ready(function () {
-    $.getJSON('/gateway_data', function (data) {
-        const tableContent = $('.table-content'); // Target the table content container
-        tableContent.empty(); // Clear existing rows
-        // Loop through JSON data and create table rows dynamically
-        data.forEach(row => {
-            const html = `
+    const tableContent = $('.table-content'); // Target the table content container
+    const loadMore = $('#load_more');
+    const pageSize = 100;
+    let sort = 'id';
+    let order = 'asc';
+    let nextCursor = null;
+    let loading = false;
+    let request = 0;
+
+    function renderRow(row) {
+        return `
 				<a href="/gateway?uid=${row[6]}" id="row_link">
 					<div class="table-row">
 						<div class="table-data" >${row[1]}</div>
 						<div class="table-data">${row[2]}</div>
-						<div class="table-data">${row[3]}</div>
-						<div class="table-data">${row[4]}</div>
+						<div class="table-data">${row[3] || 'Location information not available'}</div>
 						<div class="table-data">${row[4]}</div>
+						<div class="table-data">${row[5]}</div>
 					</div>
 				</a>`;
-            tableContent.append(html); // Append the new row to the table
+    }
+
+    // Fetch one page, sorted by the server; next_cursor marks where the following page starts
+    function loadPage(reset) {
+        if (!reset && (loading || !nextCursor)) return;
+        const current = ++request;
+        loading = true;
+        const params = { limit: pageSize, sort: sort, order: order };
+        if (!reset) params.cursor = nextCursor;
+        $.getJSON('/gateway_data', params, function (page) {
+            // A newer request (another sort) supersedes this one
+            if (current !== request) return;
+            if (reset) tableContent.empty(); // Clear existing rows
+            page.items.forEach(row => tableContent.append(renderRow(row)));
+            nextCursor = page.next_cursor;
+            loadMore.prop('hidden', !nextCursor);
+        }).always(function () {
+            if (current === request) loading = false;
+        });
+    }
+
+    $.each(sortColumns, function (id, column) {
+        $('#' + id).click(function (e) {
+            e.preventDefault();
+            // Clicking the active column flips the order, another column starts ascending
+            order = (sort === column && order === 'asc') ? 'desc' : 'asc';
+            sort = column;
+            $('.filter__link').removeClass('filter__link--active asc desc');
+            $(this).addClass('filter__link--active ' + order);
+            loadPage(true);
         });
     });
-});
\ No newline at end of file
+
+    // Further pages are loaded on demand, from the button or when scrolling near the end of the list
+    loadMore.click(function () {
+        loadPage(false);
+    });
+    $(window).on('scroll', function () {
+        if ($(window).scrollTop() + $(window).height() >= $(document).height() - 200) {
+            loadPage(false);
+        }
+    });
+
+    loadPage(true);
+});
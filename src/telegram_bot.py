@@ -2,17 +2,23 @@ from telegram.constants import ParseMode
 from config import check_telegram_status, get_telegram_details
 import time
 import os
+import queue
+import threading
 import requests
 from log import logger
 # Replace with your bot token from BotFather
 TOKEN = os.getenv('BOT_ID')
 # Replace with your chat ID (you can get this by sending a message to your bot and checking the updates)
 CHAT_ID = os.getenv('CHAT_ID')
+# Base URL of the Bot API, can point at a local stand-in server for testing
+API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
 
 
-def send_telegram_alert(name, eui, issue, message, severity, isGw=False):
+def format_alert(name, eui, issue, message, severity, isGw=False):
     if isGw:
-        alert = f'''🔴<b>Gateway Alert -- {issue}</b>
+        return f'''🔴<b>Gateway Alert -- {issue}</b>
 --------------------------------------------------------------
 <b> Name:</b> {name}
 <b> EUI:</b> {eui}
@@ -20,8 +26,7 @@ def send_telegram_alert(name, eui, issue, message, severity, isGw=False):
 --------------------------------------------------------------
 <b> {issue}</b> - {message}
 '''
-    else:
-        alert = f'''❗<b>Device Alert -- {issue}</b>
+    return f'''❗<b>Device Alert -- {issue}</b>
 --------------------------------------------------------------
 <b> Name:</b> {name}
 <b> EUI:</b> {eui}
@@ -29,17 +34,142 @@ def send_telegram_alert(name, eui, issue, message, severity, isGw=False):
 --------------------------------------------------------------
 <b> {issue}</b> - {message}
 '''
-    if TOKEN != '' and CHAT_ID != '':
-        """Send a message to Telegram synchronously using the Telegram Bot API."""
-        url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
+
+def format_digest(alerts):
+    """
+    Fold many alerts into as few messages as possible, one line per alert,
+    keeping each message under Telegram's length limit.
+    """
+    header = f"🚨<b>Alert Digest -- {len(alerts)} new alerts</b>\n--------------------------------------------------------------\n"
+    messages = []
+    text = header
+    for name, eui, issue, message, severity, isGw in alerts:
+        line = f"{'🔴' if isGw else '❗'} <b>{issue}</b> - {name} ({eui}) - {severity} - {message}\n"
+        if len(text) + len(line) > MAX_MESSAGE_LENGTH:
+            messages.append(text)
+            text = header
+        text += line
+    messages.append(text)
+    return messages
+
+
+class telegram_notifier:
+    """
+    Sends alert notifications from a background thread so detection tasks
+    never wait on the Telegram API. Alerts queued within batch_delay of each
+    other are sent together; more than digest_threshold of them are folded
+    into a digest instead of one message each. Messages are spaced at least
+    min_interval apart, a 429 waits for the retry_after Telegram asks for and
+    other failures are retried with exponential backoff.
+    """
+    def __init__(self, batch_delay=1.0, digest_threshold=3, min_interval=1.0, max_retries=5, timeout=10):
+        self.batch_delay = batch_delay
+        self.digest_threshold = digest_threshold
+        self.min_interval = min_interval
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.worker = None
+        self.session = None
+        self.last_sent = 0.0
+
+    def _ensure_worker(self):
+        # Web servers and Celery fork after import, so the worker thread is started lazily in each process
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.Queue()
+                self.session = requests.Session()
+                self.worker = threading.Thread(target=self._run, name="telegram-notifier", daemon=True)
+                self.worker.start()
+
+    def enqueue(self, name, eui, issue, message, severity, isGw=False):
+        self._ensure_worker()
+        self.queue.put((name, eui, issue, message, severity, isGw))
+
+    def flush(self, timeout=30):
+        # Wait until queued alerts have been delivered (or given up on)
+        if self.pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def _run(self):
+        while True:
+            alerts = [self.queue.get()]
+            # Give an alert storm a moment to arrive so it can be folded into one digest
+            time.sleep(self.batch_delay)
+            while True:
+                try:
+                    alerts.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if len(alerts) > self.digest_threshold:
+                    messages = format_digest(alerts)
+                else:
+                    messages = [format_alert(*alert) for alert in alerts]
+                for text in messages:
+                    self._send(text)
+            except Exception as e:
+                logger.error(f"Failed to send Telegram message: {e}")
+            finally:
+                for _ in alerts:
+                    self.queue.task_done()
+
+    def _send(self, text):
+        # Read at send time so credentials saved through the config page apply without a restart
+        token, chat_id = os.getenv('BOT_ID'), os.getenv('CHAT_ID')
+        if not token or not chat_id:
+            return
+        url = f"{API_URL}/bot{token}/sendMessage"
         payload = {
-            "chat_id": CHAT_ID,
-            "text": alert,
+            "chat_id": chat_id,
+            "text": text,
             "parse_mode": "HTML"
         }
-        try:
-            response = requests.post(url, json=payload)
-            response.raise_for_status()  # Raise an error for bad status codes
-            logger.info("Telegram Message sent successfully!")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to send Telegram message: {e}")
+        backoff = 1.0
+        for attempt in range(self.max_retries):
+            wait = self.min_interval - (time.monotonic() - self.last_sent)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                self.last_sent = time.monotonic()
+                if response.status_code == 429:
+                    # Telegram says how long to back off in parameters.retry_after
+                    retry_after = response.json().get('parameters', {}).get('retry_after', backoff)
+                    logger.warning(f"Telegram rate limit hit, retrying in {retry_after}s")
+                    time.sleep(retry_after)
+                    continue
+                if response.status_code < 500:
+                    response.raise_for_status()  # Raise an error for bad status codes
+                    logger.info("Telegram Message sent successfully!")
+                    return
+                logger.warning(f"Telegram API returned {response.status_code}, retrying in {backoff}s")
+            except requests.exceptions.HTTPError as e:
+                # Client errors (bad token, bad chat ID, ...) will not succeed on retry
+                logger.error(f"Failed to send Telegram message: {e}")
+                return
+            except requests.exceptions.RequestException as e:
+                self.last_sent = time.monotonic()
+                logger.warning(f"Telegram request failed, retrying in {backoff}s: {e}")
+            time.sleep(backoff)
+            backoff *= 2
+        logger.error(f"Failed to send Telegram message after {self.max_retries} attempts")
+
+
+notifier = telegram_notifier(
+    batch_delay=float(os.getenv('TELEGRAM_BATCH_DELAY', 1.0)),
+    digest_threshold=int(os.getenv('TELEGRAM_DIGEST_THRESHOLD', 3)),
+    min_interval=float(os.getenv('TELEGRAM_MIN_INTERVAL', 1.0)),
+    max_retries=int(os.getenv('TELEGRAM_MAX_RETRIES', 5)),
+    timeout=float(os.getenv('TELEGRAM_TIMEOUT', 10))
+)
+
+def send_telegram_alert(name, eui, issue, message, severity, isGw=False):
+    # Queue the alert for the notifier thread, delivery happens in the background
+    notifier.enqueue(name, eui, issue, message, severity, isGw)
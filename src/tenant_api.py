@@ -1,24 +1,18 @@
-import os
 import grpc
-import json
 from chirpstack_api import api
-from google.protobuf.json_format import MessageToJson
 from datetime import datetime, timedelta
 from google.protobuf.timestamp_pb2 import Timestamp
+from chirpstack import get_stub, paginate
+from protobuf_convert import tenant_item_to_dict
 from log import logger
 
+def iter_tenants():
+     client = get_stub(api.TenantServiceStub)
+     return paginate(client.List, api.ListTenantsRequest)
+
 def get_tenant_list():
-     # Get environment variables
-     api_token = os.getenv('CHIRPSTACK_APIKEY')
-     chirpstack_server = os.getenv('CHIRPSTACK_SERVER')
-     auth_token = [("authorization", "Bearer %s" % api_token)]
      try:
-        with grpc.insecure_channel(chirpstack_server) as channel:
-          client = api.TenantServiceStub(channel)
-          req = api.ListTenantsRequest()
-          req.limit = 100 #mandatory if you want details
-          resp = client.List(req, metadata=auth_token)
-          return json.loads(MessageToJson(resp))['result']
+          return [tenant_item_to_dict(tenant) for tenant in iter_tenants()]
      except grpc.RpcError as e:
         logger.error(e)
      
@@ -0,0 +1,72 @@
+import os
+import mmap
+import fcntl
+import struct
+import threading
+
+# File holding the change counters, shared by the web and worker processes like the databases
+VERSION_FILE = os.getenv('VERSION_FILE', 'storage/versions.bin')
+
+# Layout: an 8 byte random epoch followed by one unsigned 64-bit counter per slot
+SLOTS = ('alert', 'gw_alert', 'device', 'gateway')
+EPOCH_SIZE = 8
+COUNTER = struct.Struct('<Q')
+
+
+class version_counters:
+    """
+    Monotonic change counters of the alert, device and gateway tables kept in
+    a small memory-mapped file, so any process can tell whether a table
+    changed without opening SQLite. Writers increment under an exclusive
+    file lock; readers just read the mapped bytes. The epoch changes when
+    the file is recreated, so old ETags never match restarted counters.
+    """
+    def __init__(self, path=VERSION_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file = None
+        self.map = None
+
+    def _mapped(self):
+        # Mappings are not shared across a fork, each process opens its own
+        if self.pid != os.getpid() or self.map is None:
+            with self.lock:
+                if self.pid != os.getpid() or self.map is None:
+                    size = EPOCH_SIZE + COUNTER.size * len(SLOTS)
+                    file = open(self.path, 'a+b')
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                    try:
+                        if os.fstat(file.fileno()).st_size < size:
+                            file.truncate(0)
+                            file.write(os.urandom(EPOCH_SIZE) + bytes(size - EPOCH_SIZE))
+                            file.flush()
+                    finally:
+                        fcntl.flock(file, fcntl.LOCK_UN)
+                    self.map = mmap.mmap(file.fileno(), size)
+                    self.file = file
+                    self.pid = os.getpid()
+        return self.map
+
+    def _offset(self, name):
+        return EPOCH_SIZE + COUNTER.size * SLOTS.index(name)
+
+    def get(self, name):
+        return COUNTER.unpack_from(self._mapped(), self._offset(name))[0]
+
+    def bump(self, name):
+        mapped = self._mapped()
+        offset = self._offset(name)
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            COUNTER.pack_into(mapped, offset, COUNTER.unpack_from(mapped, offset)[0] + 1)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def etag(self, *names):
+        mapped = self._mapped()
+        epoch = mapped[:EPOCH_SIZE].hex()
+        return '-'.join([epoch] + [str(self.get(name)) for name in names])
+
+
+counters = version_counters()